@@ -2,7 +2,7 @@ import os
 import streamlit as st
 
 from utils.users import require_admin
-from utils.base_legal import get_status, save_uploaded_table
+from utils.base_legal import FILES, diff_versions, get_status, list_history, save_uploaded_table
 
 st.set_page_config(page_title="Admin - Base Legal", page_icon="📚", layout="wide")
 
@@ -13,33 +13,57 @@ st.caption("Aqui você faz upload das planilhas que serão usadas como **fonte d
 
 status = get_status()
 
+
+def _upload_section(key: str, titulo: str) -> None:
+    st.subheader(titulo)
+    st.write(f"Status: {'✅' if status[key].ok else '❌'} {status[key].message}")
+    st.write(f"Linhas: {status[key].rows}")
+    up = st.file_uploader(f"Upload {FILES[key]}", type=["xlsx"], key=f"up_{key}")
+    if up is None:
+        return
+    # The uploader keeps the file across reruns: save each upload once and
+    # keep showing the result (and diff) of that single save
+    handled = st.session_state.setdefault("_bl_uploads", {})
+    res = handled.get(up.file_id)
+    if res is None:
+        res = handled[up.file_id] = save_uploaded_table(key, up.getvalue())
+    if not res.ok:
+        st.error(res.message)
+        return
+    st.success(res.message)
+    if res.diff is not None:
+        st.caption(f"Alterações: {res.diff.summary()}")
+
+
 col1, col2, col3 = st.columns(3)
 with col1:
-    st.subheader("NCM")
-    st.write(f"Status: {'✅' if status['ncm'].ok else '❌'} {status['ncm'].message}")
-    st.write(f"Linhas: {status['ncm'].rows}")
-    up_ncm = st.file_uploader("Upload ncm_regras.xlsx", type=["xlsx"], key="up_ncm")
-    if up_ncm is not None:
-        res = save_uploaded_table("ncm", up_ncm.read())
-        st.success(res.message) if res.ok else st.error(res.message)
-
+    _upload_section("ncm", "NCM")
 with col2:
-    st.subheader("CFOP")
-    st.write(f"Status: {'✅' if status['cfop'].ok else '❌'} {status['cfop'].message}")
-    st.write(f"Linhas: {status['cfop'].rows}")
-    up_cfop = st.file_uploader("Upload cfop_regras.xlsx", type=["xlsx"], key="up_cfop")
-    if up_cfop is not None:
-        res = save_uploaded_table("cfop", up_cfop.read())
-        st.success(res.message) if res.ok else st.error(res.message)
-
+    _upload_section("cfop", "CFOP")
 with col3:
-    st.subheader("CST / CSOSN")
-    st.write(f"Status: {'✅' if status['cst'].ok else '❌'} {status['cst'].message}")
-    st.write(f"Linhas: {status['cst'].rows}")
-    up_cst = st.file_uploader("Upload cst_csosn_regras.xlsx", type=["xlsx"], key="up_cst")
-    if up_cst is not None:
-        res = save_uploaded_table("cst", up_cst.read())
-        st.success(res.message) if res.ok else st.error(res.message)
+    _upload_section("cst", "CST / CSOSN")
+
+st.divider()
+st.subheader("Histórico — comparar versões")
+st.caption("Compara um backup de `history/` com a versão vigente, por código (NCM/CFOP/CST/CSOSN).")
+hcol1, hcol2 = st.columns([1, 3])
+with hcol1:
+    h_key = st.selectbox("Tabela", list(FILES.keys()), format_func=lambda k: FILES[k])
+history = list_history(h_key)
+with hcol2:
+    h_path = st.selectbox("Versão anterior", list(reversed(history)), format_func=lambda p: p.name) if history else None
+if h_path is None:
+    st.info("Nenhum backup encontrado para esta tabela.")
+else:
+    try:
+        d = diff_versions(h_key, old_path=h_path)
+        st.write(d.summary())
+        st.dataframe(
+            [{"codigo": c, "mudanca": m} for m, codes in (("adicionado", d.added), ("removido", d.removed), ("alterado", d.changed)) for c in sorted(codes)],
+            use_container_width=True,
+        )
+    except Exception as e:
+        st.error(f"Falha ao comparar versões: {e}")
 
 st.divider()
 st.markdown("""
@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import os
+import threading
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .validator import FINDING_COLS, META_COLS
+
+try:  # optional dependency: without pyarrow the price history is not persisted
+    import pyarrow  # noqa: F401
+except Exception:  # pragma: no cover
+    pyarrow = None
+
+BASE_DIR = Path(__file__).resolve().parents[2]  # project root (agente_leitor_xml_fiscal)
+ANOMALIAS_DIR = BASE_DIR / "data" / "anomalias"
+
+# Product key: "xProd" = normalized description (across suppliers);
+# "cProd" = supplier product code (issuer CNPJ + cProd)
+CHAVES = ("xProd", "cProd")
+
+LIMIAR_Z = 3.5             # robust z-score (0.6745 * |x - mediana| / MAD) above which a price is atypical
+MIN_AMOSTRAS = 5           # fewer observations per product -> no statistics, no finding
+MAD_MIN_REL = 0.05         # MAD floor as a fraction of the median (products with a single price)
+MAX_HISTORICO_POR_PRODUTO = 200
+# Usual packaging/scale factors: a price ~N x (or 1/N of) the median with one
+# of these points at unit/quantity scale (CX x UN, KG x G...) rather than price.
+# Small factors (2-5x) are too common in genuine price outliers to tell apart.
+FATORES_ESCALA = np.array([6, 8, 10, 12, 15, 16, 20, 24, 25, 30, 36, 40, 48, 50, 60, 100, 144, 500, 1000])
+TOL_ESCALA = 0.03
+
+HIST_COLS = ["produto", "uCom", "vUnCom", "ref"]
+
+_HIST_LOCK = threading.Lock()
+
+
+def historico_disponivel() -> bool:
+    return pyarrow is not None
+
+
+def historico_path(chave: str = "xProd") -> Path:
+    return ANOMALIAS_DIR / f"historico_precos_{chave}.parquet"
+
+
+def _texto(df: pd.DataFrame, name: str) -> pd.Series:
+    if name not in df.columns:
+        return pd.Series("", index=df.index, dtype=object)
+    return df[name].fillna("").astype(str).str.strip()
+
+
+def _codigos(df: pd.DataFrame, name: str, normalizar: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Factorize a text column: (codes, cleaned distinct values). String work
+    runs once per distinct value, not per item; missing -> "".
+    """
+    if name not in df.columns:
+        return np.zeros(len(df), dtype=np.intp), np.array([""], dtype=object)
+    codes, uniques = pd.factorize(df[name].to_numpy())
+    s = pd.Series(uniques, dtype=object).astype(str).str.strip()
+    if normalizar:
+        s = (
+            s.str.normalize("NFKD").str.encode("ascii", "ignore").str.decode("ascii")
+            .str.upper().str.replace(r"\s+", " ", regex=True)
+        )
+    # NaN (code -1) becomes the trailing ""; equal cleaned values share one code
+    codes2, uniques2 = pd.factorize(np.append(s.to_numpy(dtype=object), ""))
+    return codes2[codes], uniques2.astype(object)
+
+
+def chave_produto(df_itens: pd.DataFrame, chave: str = "xProd") -> pd.Series:
+    """Product key per item ("" when the item has none)."""
+    if chave not in CHAVES:
+        raise ValueError(f"chave deve ser uma de {CHAVES}")
+    if chave == "xProd":
+        codes, uniques = _codigos(df_itens, "xProd", normalizar=True)
+        return pd.Series(uniques[codes], index=df_itens.index, dtype=object)
+    c_emit, u_emit = _codigos(df_itens, "emit_CNPJ")
+    c_prod, u_prod = _codigos(df_itens, "cProd")
+    par, pares = pd.factorize(c_emit.astype(np.int64) * len(u_prod) + c_prod)
+    texto = np.where(u_prod[pares % len(u_prod)] == "", "",
+                     u_emit[pares // len(u_prod)] + "|" + u_prod[pares % len(u_prod)])
+    return pd.Series(texto.astype(object)[par], index=df_itens.index, dtype=object)
+
+
+def observacoes(df_itens: pd.DataFrame, chave: str = "xProd", com_ref: bool = True) -> pd.DataFrame:
+    """
+    One price observation per item with a product key and a positive vUnCom
+    (history layout). `ref` (chave:nItem) is only needed to merge with history.
+    """
+    preco = pd.to_numeric(df_itens["vUnCom"], errors="coerce") if "vUnCom" in df_itens.columns \
+        else pd.Series(np.nan, index=df_itens.index)
+    un_codes, unidades = _codigos(df_itens, "uCom", normalizar=True)
+    obs = pd.DataFrame({
+        "produto": chave_produto(df_itens, chave),
+        "uCom": unidades[un_codes],
+        "vUnCom": preco.astype(float),
+    }, index=df_itens.index)
+    ok = (obs["produto"] != "") & (obs["vUnCom"] > 0)
+    obs = obs[ok]
+    if com_ref:
+        sel = df_itens.loc[ok]
+        obs["ref"] = _texto(sel, "chave") + ":" + _texto(sel, "nItem")
+    return obs
+
+
+def carregar_historico(chave: str = "xProd", path: Optional[Path] = None) -> pd.DataFrame:
+    path = Path(path) if path else historico_path(chave)
+    if pyarrow is None or not path.exists():
+        return pd.DataFrame(columns=HIST_COLS)
+    return pd.read_parquet(path, columns=HIST_COLS)
+
+
+def atualizar_historico(df_itens: pd.DataFrame, chave: str = "xProd", path: Optional[Path] = None,
+                        max_por_produto: int = MAX_HISTORICO_POR_PRODUTO) -> int:
+    """
+    Append the items' prices to the persisted history, keeping the latest
+    `max_por_produto` observations per product. Items already recorded
+    (same chave:nItem) are not added twice. Returns the history size.
+    """
+    if pyarrow is None:
+        return 0
+    path = Path(path) if path else historico_path(chave)
+    with _HIST_LOCK:
+        hist = carregar_historico(chave, path)
+        novo = observacoes(df_itens, chave)
+        if not hist.empty:
+            novo = pd.concat([hist[~hist["ref"].isin(novo["ref"])], novo[HIST_COLS]], ignore_index=True)
+        hist = novo[HIST_COLS]
+        hist = hist.groupby("produto", sort=False).tail(max_por_produto).reset_index(drop=True)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        hist.to_parquet(tmp, index=False)
+        os.replace(tmp, path)
+    return len(hist)
+
+
+def _fmt(x: pd.Series) -> pd.Series:
+    return x.map("{:.4f}".format).str.rstrip("0").str.rstrip(".")
+
+
+def detectar_anomalias(df_itens: pd.DataFrame, historico: Optional[pd.DataFrame] = None,
+                       chave: str = "xProd", limiar: float = LIMIAR_Z,
+                       min_amostras: int = MIN_AMOSTRAS) -> pd.DataFrame:
+    """
+    Flag items whose vUnCom deviates from the usual price of the product
+    (median/MAD over the items plus `historico`, see `carregar_historico`).
+    Statistics use the product's predominant unit; a deviation that matches
+    a packaging factor, or comes with another uCom, is reported as a unit
+    or scale problem. Returns ALERTA finding rows (same columns as `validar_itens`).
+    """
+    com_historico = historico is not None and not historico.empty
+    obs = observacoes(df_itens, chave, com_ref=com_historico)
+    if obs.empty:
+        return pd.DataFrame(columns=FINDING_COLS)
+    ref = obs
+    if com_historico:
+        ref = pd.concat([historico.loc[~historico["ref"].isin(obs["ref"]), HIST_COLS], obs], ignore_index=True)
+
+    # Integer codes for product and unit; everything below is grouped numpy/pandas
+    prod_codes, produtos = pd.factorize(ref["produto"].to_numpy())
+    un_codes, unidades = pd.factorize(ref["uCom"].to_numpy())
+    por_unidade = pd.Series(1, index=pd.MultiIndex.from_arrays([prod_codes, un_codes])).groupby(level=[0, 1]).size()
+    dominante = por_unidade.sort_values(ascending=False, kind="stable").groupby(level=0).head(1)
+    un_dom = np.full(len(produtos), -1, dtype=np.int64)
+    un_dom[dominante.index.get_level_values(0)] = dominante.index.get_level_values(1)
+
+    na_dominante = un_codes == un_dom[prod_codes]
+    preco = ref["vUnCom"].to_numpy()[na_dominante]
+    grupo = prod_codes[na_dominante]
+    g = pd.Series(preco).groupby(grupo)
+    mediana = g.median()
+    stats = pd.DataFrame({
+        "n": g.size(),
+        "mediana": mediana,
+        "mad": pd.Series(np.abs(preco - mediana.reindex(grupo).to_numpy())).groupby(grupo).median(),
+        "p05": g.quantile(0.05),
+        "p95": g.quantile(0.95),
+    }).reindex(np.arange(len(produtos)))
+
+    # Current items only (the tail of `ref`): history is reference, not reported
+    k = prod_codes[len(ref) - len(obs):]
+    s = stats.iloc[k]
+    n = s["n"].fillna(0).to_numpy()
+    med = s["mediana"].to_numpy()
+    escala = np.maximum(s["mad"].to_numpy(), MAD_MIN_REL * med)
+    x = obs["vUnCom"].to_numpy()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        z = 0.6745 * (x - med) / escala
+        razao = x / med
+    atipico = (n >= min_amostras) & (np.abs(z) > limiar)
+    if not atipico.any():
+        return pd.DataFrame(columns=FINDING_COLS)
+
+    # Unit/scale check only on the flagged rows
+    pos = np.flatnonzero(atipico)
+    k, razao, sub = k[pos], razao[pos], s.iloc[pos].reset_index(drop=True)
+    outra_unidade = pd.Index(unidades).get_indexer(obs["uCom"].to_numpy()[pos]) != un_dom[k]
+    fator = np.where(razao >= 1, razao, 1 / razao)
+    proximo = FATORES_ESCALA[np.abs(fator[:, None] - FATORES_ESCALA).argmin(axis=1)]
+    unidade = outra_unidade | (np.abs(fator / proximo - 1) <= TOL_ESCALA)
+
+    it = df_itens.loc[obs.index[pos]]
+    out = pd.DataFrame({c: _texto(it, c).to_numpy() for c in META_COLS})
+    preco_s = _fmt(pd.Series(x[pos]))
+    med_s = _fmt(sub["mediana"])
+    un_s = pd.Series(obs["uCom"].to_numpy()[pos], dtype=object).replace("", "(vazia)")
+    dom_s = pd.Series(unidades[un_dom[k]], dtype=object).replace("", "(vazia)")
+    fator_s = pd.Series(np.where(razao >= 1, "", "1/")) + pd.Series(proximo).astype(str)
+    msg_preco = (
+        "vUnCom " + preco_s + " fora do padrão do produto: mediana " + med_s + ", faixa p5–p95 "
+        + _fmt(sub["p05"]) + "–" + _fmt(sub["p95"]) + " (" + sub["n"].astype(int).astype(str) + " ocorrência(s))."
+    )
+    msg_unidade = (
+        "vUnCom " + preco_s + " ≈ " + fator_s + "x a mediana do produto (" + med_s + " por " + dom_s
+        + "), uCom " + un_s + ": verifique unidade/escala da quantidade."
+    )
+    out["severidade"] = "ALERTA"
+    out["campo"] = np.where(unidade, "uCom", "vUnCom")
+    out["mensagem"] = np.where(unidade, msg_unidade, msg_preco)
+    out["regra"] = np.where(unidade, "UNIDADE_ESCALA_SUSPEITA", "PRECO_ATIPICO")
+    out["base"] = historico_path(chave).name if com_historico else ""
+    return out[FINDING_COLS]
@@ -1,25 +1,45 @@
-import io
 import os
-import zipfile
-from datetime import datetime
 
-import pandas as pd
 import streamlit as st
 
-from utils.nfe_parser import parse_nfe_xml
 from utils.users import ensure_admin, authenticate
-from utils.base_legal import ensure_base_legal, load_tables, get_status
-from utils.validator import validar_itens
 
 st.set_page_config(page_title="Agente XML Fiscal — v2", page_icon="🧾", layout="wide")
 
+
+def _secret(name: str, default: str) -> str:
+    """Streamlit secret, then env var, then default (works without a secrets.toml)."""
+    try:
+        value = st.secrets.get(name)
+    except Exception:
+        value = None
+    return value or os.environ.get(name, default)
+
+
+@st.cache_resource(show_spinner=False)
+def _bootstrap_users(admin_user: str, admin_pass: str) -> bool:
+    """Runs once per process (not on every rerun): creates the admin user if missing."""
+    ensure_admin(admin_username=admin_user, admin_password=admin_pass)
+    return True
+
+
+@st.cache_resource(show_spinner=False)
+def _bootstrap_base_legal() -> bool:
+    """Runs once per process, after login: Base Legal folders and templates."""
+    from utils.base_legal import ensure_base_legal
+    ensure_base_legal()
+    return True
+
+
 # Bootstrap admin credentials (override via Streamlit secrets/env)
-ADMIN_USER = st.secrets.get("ADMIN_USER", os.environ.get("ADMIN_USER", "admin"))
-ADMIN_PASS = st.secrets.get("ADMIN_PASS", os.environ.get("ADMIN_PASS", "admin123"))
-ensure_admin(admin_username=ADMIN_USER, admin_password=ADMIN_PASS)
+ADMIN_USER = _secret("ADMIN_USER", "admin")
+ADMIN_PASS = _secret("ADMIN_PASS", "admin123")
+# Findings rendered on screen (the exports always carry all of them)
+MAX_LINHAS_ACHADOS = 5000
+# Data rows per Excel sheet (xlsx limit is 1,048,576 including the header)
+MAX_LINHAS_EXCEL = 1_048_575
 
-# Ensure base legal templates exist
-ensure_base_legal()
+_bootstrap_users(ADMIN_USER, ADMIN_PASS)
 
 
 def require_login():
@@ -46,9 +66,37 @@ def require_login():
 
 require_login()
 
+# Data stack (pandas, pyarrow, lxml...) is only imported once logged in, so
+# the login page renders without paying for it.
+import hashlib
+import importlib.util
+import io
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+
+from utils.ingest import processar_lotes
+from utils.checkpoint import Checkpoint, limpar_antigos
+from utils.base_legal import load_tables, get_status, tables_signature
+from utils.cache_manager import AdmissionRejected, SessionBudget, admissao, shared_cache, tamanho
+from utils.validator import ROLLUP_DIMS, Achados, validar_itens_compacto
+from utils.revalidation import diff_tabelas, indexar_codigos, revalidar_incremental
+from utils.schema_validator import executor as schema_executor, schema_disponivel, validar_schema
+from utils.anomalias import atualizar_historico, carregar_historico, detectar_anomalias
+
+_bootstrap_base_legal()
+
 auth = st.session_state.auth
 st.sidebar.markdown("### aplicativo")
 st.sidebar.caption(f"Logado como: **{auth['username']}** ({auth.get('role','user')})")
+if auth.get("role") == "admin":
+    _cs = shared_cache.stats()
+    st.sidebar.caption(
+        f"Cache compartilhado: {_cs['itens']} objeto(s), {_cs['bytes'] / 2**20:.0f} MB · "
+        f"pipelines em execução: {admissao.running}"
+    )
 if st.sidebar.button("Sair"):
     st.session_state.auth = None
     st.rerun()
@@ -61,7 +109,7 @@ st.write(
 
 uploaded = st.file_uploader("Envie XML(s) ou ZIP", type=["xml", "zip"], accept_multiple_files=True)
 
-colA, colB, colC, colD = st.columns([2, 2, 2, 2])
+colA, colB, colC, colD, colE = st.columns([2, 2, 2, 2, 2])
 with colA:
     consolidar_por = st.selectbox(
         "Consolidar por",
@@ -72,8 +120,26 @@ with colB:
     incluir_cabecalho = st.checkbox("Incorporar aba 'Cabeçalho NF-e'", value=True)
 with colC:
     gerar_csv = st.checkbox("Gerar CSV junto (opcional)", value=False)
+    gerar_parquet = st.checkbox(
+        "Gerar Parquet (particionado)",
+        value=False,
+        disabled=importlib.util.find_spec("pyarrow") is None,
+        help="Notas, itens e achados em Parquet, particionados por mês de emissão e CNPJ do emitente.",
+    )
 with colD:
     executar_validacao = st.checkbox("Executar validação fiscal (Base Legal)", value=True)
+    detectar_precos = st.checkbox(
+        "Detectar preços atípicos (por produto)",
+        value=False,
+        help="Compara o vUnCom de cada item com a mediana do mesmo produto (xProd) neste lote e nos lotes anteriores.",
+    )
+with colE:
+    validar_xsd = st.checkbox(
+        "Validar estrutura (schema XSD)",
+        value=False,
+        disabled=not schema_disponivel(),
+        help="Valida cada XML contra o schema oficial da NF-e (requer lxml e schemas/nfe/).",
+    )
 
 def _read_files(uploaded_files):
     xml_payloads = []
@@ -85,7 +151,11 @@ def _read_files(uploaded_files):
                 zf = zipfile.ZipFile(io.BytesIO(data))
                 for zi in zf.infolist():
                     if zi.filename.lower().endswith(".xml"):
-                        xml_payloads.append((zi.filename, zf.read(zi)))
+                        try:
+                            xml_payloads.append((zi.filename, zf.read(zi)))
+                        except Exception as e:
+                            # unreadable member: quarantined by the ingest, the rest of the ZIP goes on
+                            xml_payloads.append((zi.filename, e))
             except Exception as e:
                 st.warning(f"Falha ao ler ZIP {name}: {e}")
         elif name.lower().endswith(".xml"):
@@ -95,38 +165,68 @@ def _read_files(uploaded_files):
 xml_files = _read_files(uploaded)
 
 if xml_files:
-    headers = []
-    itens_all = []
+    # Same upload -> same signature: the ingest checkpoint and the incremental
+    # revalidation are both keyed on it
+    assinatura = hashlib.sha1()
+    for fname, payload in xml_files:
+        assinatura.update(fname.encode("utf-8"))
+        if isinstance(payload, bytes):
+            assinatura.update(hashlib.sha1(payload).digest())
+    assinatura = assinatura.hexdigest()
+
+    orcamento = st.session_state.setdefault("_orcamento", SessionBudget())
+    tamanho_upload = sum(len(p) for _, p in xml_files if isinstance(p, bytes))
+
+    def _ingerir():
+        # Progress is committed per batch: after a crash/restart, re-uploading
+        # the same files resumes from the last committed batch
+        with admissao.admitir(estimativa=8 * tamanho_upload):
+            limpar_antigos()
+            ckpt = Checkpoint.for_upload(assinatura)
+            for _ in processar_lotes(xml_files, tamanho_lote=500, checkpoint=ckpt):
+                pass
+            return {
+                "notas": ckpt.carregar("notas"),
+                "itens": ckpt.carregar("itens"),
+                "quarentena": list(ckpt.quarentena),
+            }
+
+    def _validar_xsd():
+        # Shared long-lived workers: their compiled schemas are reused across uploads
+        with admissao.admitir(estimativa=tamanho_upload):
+            pool = schema_executor()
+            futs = [pool.submit(validar_schema, payload, fname)
+                    for fname, payload in xml_files if isinstance(payload, bytes)]
+            return pd.DataFrame([row for f in futs for row in f.result()])
+
+    # Schema validation runs on worker threads while the main thread parses.
+    # The cache lookup and the build happen in one get_or_create call, so an
+    # eviction in between cannot leave an empty result cached for this upload.
+    xsd_pool = ThreadPoolExecutor(max_workers=1) if validar_xsd else None
+    xsd_fut = xsd_pool.submit(shared_cache.get_or_create, ("xsd", assinatura), _validar_xsd) if xsd_pool else None
+
+    # Parsed results are immutable and shared by every session that uploads the same files
+    try:
+        with st.spinner("Lendo XML(s)..."):
+            ingest = shared_cache.get_or_create(("ingest", assinatura), _ingerir)
+            df_schema = xsd_fut.result() if xsd_fut is not None else pd.DataFrame()
+    except AdmissionRejected as e:
+        st.warning(f"⏳ {e}")
+        st.stop()
+    finally:
+        if xsd_pool is not None:
+            xsd_pool.shutdown(wait=False)
 
-    with st.spinner("Lendo XML(s)..."):
-        for fname, payload in xml_files:
-            try:
-                parsed = parse_nfe_xml(payload)
-                h = parsed["header"]
-                h["arquivo"] = fname
-                headers.append(h)
-                for it in parsed["items"]:
-                    row = {}
-                    row.update(h)  # include header fields for traceability
-                    row.update(it)
-                    itens_all.append(row)
-            except Exception as e:
-                st.error(f"Erro ao processar {fname}: {e}")
+    if ingest["quarentena"]:
+        with st.expander(f"⚠️ {len(ingest['quarentena'])} arquivo(s) em quarentena (não processados)"):
+            st.dataframe(pd.DataFrame(ingest["quarentena"])[["membro", "motivo"]], use_container_width=True)
 
-    if not itens_all:
+    df_notas = ingest["notas"]
+    df_itens = ingest["itens"]
+    if df_itens.empty:
         st.warning("Nenhum item encontrado nos XMLs enviados.")
         st.stop()
 
-    df_itens = pd.DataFrame(itens_all)
-
-    # numeric conversions (best-effort)
-    for c in ["qCom", "vUnCom", "vProd", "pICMS", "vICMS", "vNF"]:
-        if c in df_itens.columns:
-            df_itens[c] = pd.to_numeric(
-                df_itens[c].astype(str).str.replace(",", ".", regex=False),
-                errors="coerce",
-            )
-
     # Choose consolidation keys
     if consolidar_por.startswith("xProd +"):
         key_cols = ["xProd", "NCM", "CFOP"]
@@ -138,7 +238,7 @@ if xml_files:
         key_cols = ["xProd"]
 
     # Consolidate
-    agg = (
+    agg = orcamento.get_or_create(("agg", assinatura, tuple(key_cols)), lambda: (
         df_itens.groupby(key_cols, dropna=False, as_index=False)
         .agg(
             quantidade=("qCom", "sum"),
@@ -146,15 +246,67 @@ if xml_files:
             valor_unit_medio=("vUnCom", "mean"),
         )
         .sort_values(["valor_total"], ascending=False)
-    )
+    ))
 
     # Validation
-    df_findings = pd.DataFrame()
+    achados = Achados.vazio(df_itens)
+    reval = None
     bl_status = get_status()
+    bl_sig = tables_signature()
     if executar_validacao:
-        with st.spinner("Executando validações..."):
-            tables = load_tables()
-            df_findings = validar_itens(df_itens, tables)
+        # Same upload as the previous rerun: only revalidate items touched by Base Legal changes
+        anterior = orcamento.get("validacao_anterior")
+
+        try:
+            with st.spinner("Executando validações..."):
+                tables = shared_cache.get_or_create(("base_legal", bl_sig), load_tables)
+                if anterior and anterior["assinatura"] == assinatura and anterior["n_itens"] == len(df_itens):
+                    # Rebind to this rerun's items: if the shared ingest entry was evicted and
+                    # rebuilt, the stored findings would keep the old items frame alive
+                    achados = anterior["achados"]
+                    if achados.itens is not df_itens:
+                        achados = Achados(df_itens, achados.regra, achados.item)
+                    diffs = diff_tabelas(anterior["tables"], tables) if anterior["bl_sig"] != bl_sig else {}
+                    if diffs:
+                        # code -> items index depends only on the upload: built once, shared by every change
+                        index = shared_cache.get_or_create(("indice_codigos", assinatura),
+                                                           lambda: indexar_codigos(df_itens))
+                        reval = revalidar_incremental(df_itens, achados, tables, diffs, index=index)
+                        achados = reval.findings
+                else:
+                    with admissao.admitir(estimativa=tamanho(df_itens)):
+                        achados = validar_itens_compacto(df_itens, tables)
+        except AdmissionRejected as e:
+            st.warning(f"⏳ {e}")
+            st.stop()
+        orcamento.put("validacao_anterior", {
+            "assinatura": assinatura,
+            "n_itens": len(df_itens),
+            "bl_sig": bl_sig,
+            "tables": tables,
+            "achados": achados,
+        })
+
+    # Price anomalies: compared with the persisted history, which then takes this upload in
+    df_anomalias = pd.DataFrame()
+    if detectar_precos:
+        def _anomalias():
+            with admissao.admitir(estimativa=tamanho(df_itens)):
+                out = detectar_anomalias(df_itens, carregar_historico())
+                atualizar_historico(df_itens)
+            return out
+
+        try:
+            with st.spinner("Procurando preços atípicos..."):
+                df_anomalias = orcamento.get_or_create(("anomalias", assinatura), _anomalias)
+        except AdmissionRejected as e:
+            st.warning(f"⏳ {e}")
+
+    # Findings kept as plain rows (XSD, price anomalies), shown and exported next to `achados`
+    extras = [d for d in (df_schema, df_anomalias) if not d.empty]
+    df_extras = pd.concat(extras, ignore_index=True) if extras else pd.DataFrame()
+    # Derived artifacts below depend on the upload, the Base Legal and these options
+    artefato = (assinatura, bl_sig, executar_validacao, validar_xsd, detectar_precos)
 
     # UI tabs
     tabs = st.tabs(["Itens (leitura bruta)", "Consolidado", "Validação", "Base Legal (status)"])
@@ -169,18 +321,46 @@ if xml_files:
 
     with tabs[2]:
         st.subheader("Validação fiscal (CFOP/NCM/CST/CSOSN)")
-        if not executar_validacao:
+        if reval is not None:
+            with st.expander("🔄 Base Legal alterada — o que mudou nos achados", expanded=True):
+                st.caption(
+                    " · ".join(f"{k.upper()}: {d.summary()}" for k, d in reval.diffs.items())
+                    + f" — {reval.itens_afetados} de {reval.itens_total} item(ns) revalidado(s)."
+                )
+                c1, c2 = st.columns(2)
+                with c1:
+                    st.metric("Novos achados", len(reval.novos))
+                    if not reval.novos.empty:
+                        st.dataframe(reval.novos.to_frame(0, MAX_LINHAS_ACHADOS), use_container_width=True, height=200)
+                with c2:
+                    st.metric("Achados resolvidos", len(reval.resolvidos))
+                    if not reval.resolvidos.empty:
+                        st.dataframe(reval.resolvidos.to_frame(0, MAX_LINHAS_ACHADOS), use_container_width=True, height=200)
+        if not executar_validacao and achados.empty and df_extras.empty:
             st.info("Validação desativada no topo. Marque a opção para executar.")
-        elif df_findings.empty:
+        elif achados.empty and df_extras.empty:
             st.success("Nenhuma inconsistência encontrada nas regras atuais (ou a base está vazia).")
         else:
-            # Summary
+            # Summary (counts are precomputed, the chosen rollup is built once; rows are only rendered for display)
+            sev_extras = df_extras["severidade"].value_counts() if not df_extras.empty else {}
             c1, c2 = st.columns(2)
             with c1:
-                st.metric("Erros", int((df_findings["severidade"] == "ERRO").sum()))
+                st.metric("Erros", achados.erros + int(sev_extras.get("ERRO", 0)))
             with c2:
-                st.metric("Alertas", int((df_findings["severidade"] == "ALERTA").sum()))
-            st.dataframe(df_findings, use_container_width=True, height=360)
+                st.metric("Alertas", achados.alertas + int(sev_extras.get("ALERTA", 0)))
+            if not df_schema.empty:
+                with st.expander(f"Schema XSD — {len(df_schema)} achado(s)"):
+                    st.dataframe(df_schema, use_container_width=True, height=240)
+            if not df_anomalias.empty:
+                with st.expander(f"Preços atípicos — {len(df_anomalias)} achado(s)"):
+                    st.dataframe(df_anomalias, use_container_width=True, height=240)
+            if not achados.empty:
+                dim = st.radio("Agrupar por", ROLLUP_DIMS, horizontal=True)
+                st.dataframe(achados.rollup(dim), use_container_width=True, height=240)
+                with st.expander(f"Detalhe ({len(achados)} achado(s))"):
+                    st.dataframe(achados.to_frame(0, MAX_LINHAS_ACHADOS), use_container_width=True, height=360)
+                    if len(achados) > MAX_LINHAS_ACHADOS:
+                        st.caption(f"Exibindo os primeiros {MAX_LINHAS_ACHADOS} achados. A lista completa está nas exportações.")
 
     with tabs[3]:
         st.subheader("Status da Base Legal vigente")
@@ -196,30 +376,93 @@ if xml_files:
     st.subheader("Exportações")
 
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    buffer = io.BytesIO()
-    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
-        if incluir_cabecalho:
-            pd.DataFrame(headers).to_excel(writer, sheet_name="Cabecalho_NFe", index=False)
-        df_itens.to_excel(writer, sheet_name="Itens_Bruto", index=False)
-        agg.to_excel(writer, sheet_name="Consolidado", index=False)
-        if executar_validacao:
-            df_findings.to_excel(writer, sheet_name="Validacao", index=False)
-    buffer.seek(0)
-
-    st.download_button(
-        "📥 Baixar Excel (com abas)",
-        data=buffer,
-        file_name=f"xml_fiscal_v2_{ts}.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-    )
+
+    def _excel() -> bytes:
+        # xlsx sheets stop at 1,048,576 rows: larger tables are cut and the
+        # Validação totals go to their own sheet (full list: CSV/Parquet)
+        cortadas = []
+
+        def _aba(writer, df, nome):
+            if len(df) > MAX_LINHAS_EXCEL:
+                cortadas.append(f"{nome}: primeiras {MAX_LINHAS_EXCEL} de {len(df)} linhas")
+                df = df.iloc[:MAX_LINHAS_EXCEL]
+            df.to_excel(writer, sheet_name=nome, index=False)
+
+        buffer = io.BytesIO()
+        with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
+            if incluir_cabecalho:
+                _aba(writer, df_notas, "Cabecalho_NFe")
+            _aba(writer, df_itens, "Itens_Bruto")
+            _aba(writer, agg, "Consolidado")
+            if executar_validacao or not df_extras.empty:
+                limite = max(MAX_LINHAS_EXCEL - len(df_extras), 0)
+                if len(df_extras) + len(achados) > MAX_LINHAS_EXCEL:
+                    cortadas.append(f"Validacao: primeiros {MAX_LINHAS_EXCEL} de {len(df_extras) + len(achados)} achados")
+                pd.concat([df_extras.iloc[:MAX_LINHAS_EXCEL], achados.to_frame(0, limite)], ignore_index=True).to_excel(
+                    writer, sheet_name="Validacao", index=False)
+                resumo = [achados.rollup("regra")]
+                if not df_extras.empty:
+                    resumo.append(df_extras.groupby(["regra", "severidade", "campo"], as_index=False)
+                                  .size().rename(columns={"size": "total"}))
+                pd.concat(resumo, ignore_index=True).to_excel(writer, sheet_name="Validacao_Resumo", index=False)
+            if cortadas:
+                pd.DataFrame({"aviso": cortadas + ["Lista completa: exportação Parquet/CSV."]}).to_excel(
+                    writer, sheet_name="Avisos", index=False)
+        return buffer.getvalue()
+
+    def _exportacao(nome, fator, build):
+        """Build an export artifact under admission control (`fator` x the data size in memory)."""
+        def _build():
+            with admissao.admitir(estimativa=fator * (tamanho(df_itens) + tamanho(df_notas))):
+                return build()
+
+        try:
+            return orcamento.get_or_create(nome, _build)
+        except AdmissionRejected as e:
+            st.warning(f"⏳ {e}")
+            return None
+
+    # The workbook is only built on request (and kept in the session budget);
+    # xlsxwriter holds every cell in memory until the file is closed
+    chave_excel = ("excel", artefato, tuple(key_cols), incluir_cabecalho)
+    if orcamento.get(chave_excel) is not None or st.button("Preparar Excel (com abas)"):
+        with st.spinner("Gerando Excel..."):
+            excel = _exportacao(chave_excel, 4, _excel)
+        if excel is not None:
+            st.download_button(
+                "📥 Baixar Excel (com abas)",
+                data=excel,
+                file_name=f"xml_fiscal_v2_{ts}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            )
 
     if gerar_csv:
-        st.download_button(
-            "📥 Baixar CSV (Itens_Bruto)",
-            data=df_itens.to_csv(index=False).encode("utf-8-sig"),
-            file_name=f"itens_bruto_{ts}.csv",
-            mime="text/csv",
-        )
+        csv = _exportacao(("csv", assinatura), 1, lambda: df_itens.to_csv(index=False).encode("utf-8-sig"))
+        if csv is not None:
+            st.download_button(
+                "📥 Baixar CSV (Itens_Bruto)",
+                data=csv,
+                file_name=f"itens_bruto_{ts}.csv",
+                mime="text/csv",
+            )
+
+    if gerar_parquet:
+        from utils.parquet_export import exportar_zip
+
+        with st.spinner("Gerando Parquet..."):
+            parquet_zip = _exportacao(("parquet", artefato), 2, lambda: exportar_zip(
+                df_notas,
+                df_itens,
+                achados,
+                df_extras if not df_extras.empty else None,
+            ))
+        if parquet_zip is not None:
+            st.download_button(
+                "📥 Baixar Parquet (notas/itens/achados, .zip)",
+                data=parquet_zip,
+                file_name=f"xml_fiscal_parquet_{ts}.zip",
+                mime="application/zip",
+            )
 
 else:
     st.info("Envie ao menos 1 XML ou 1 ZIP contendo XMLs para começar.")
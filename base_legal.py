@@ -1,9 +1,10 @@
 from __future__ import annotations
 
+import hashlib
 import os
 from pathlib import Path
-from dataclasses import dataclass
-from typing import Dict, Optional, Tuple
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
 
 import pandas as pd
 
@@ -27,16 +28,56 @@ REQUIRED_COLS = {
     "cst": ["codigo", "tipo", "descricao"],  # tipo: CST or CSOSN
 }
 
+@dataclass
+class BaseLegalDiff:
+    """Codes added/removed/changed between two versions of one table.
+
+    Codes are normalized exactly as in `validar_itens`; CST/CSOSN codes are
+    prefixed with their tipo ("CST:00", "CSOSN:102"). `toggled` lists the
+    lookups that went from empty to non-empty (or back): the validator skips
+    an empty lookup entirely, so every item using that field is affected.
+    """
+    key: str
+    added: Set[str] = field(default_factory=set)
+    removed: Set[str] = field(default_factory=set)
+    changed: Set[str] = field(default_factory=set)
+    toggled: Set[str] = field(default_factory=set)
+
+    @property
+    def codes(self) -> Set[str]:
+        return self.added | self.removed | self.changed
+
+    def __bool__(self) -> bool:
+        return bool(self.codes or self.toggled)
+
+    def summary(self) -> str:
+        return (f"{len(self.added)} adicionado(s), {len(self.removed)} removido(s), "
+                f"{len(self.changed)} alterado(s)")
+
+
 @dataclass
 class BaseLegalStatus:
     ok: bool
     message: str
     rows: int = 0
     path: Optional[str] = None
+    diff: Optional[BaseLegalDiff] = None
+
+
+# Set once templates are known to exist; files are only ever replaced atomically
+_ensured = False
+
+# key -> ((mtime_ns, size), status): get_status only rereads a file that changed
+_STATUS_CACHE: Dict[str, Tuple[Tuple[int, int], BaseLegalStatus]] = {}
+# key -> ((mtime_ns, size), sha1 digest): tables_signature only rehashes a file that changed
+_DIGEST_CACHE: Dict[str, Tuple[Tuple[int, int], bytes]] = {}
 
 
 def ensure_base_legal() -> None:
     """Create folders and starter templates if missing."""
+    global _ensured
+    if _ensured and all((CURRENT_DIR / f).exists() for f in FILES.values()):
+        return
     CURRENT_DIR.mkdir(parents=True, exist_ok=True)
     HISTORY_DIR.mkdir(parents=True, exist_ok=True)
 
@@ -59,6 +100,7 @@ def ensure_base_legal() -> None:
             {"codigo": "102", "tipo": "CSOSN", "descricao": "Tributada pelo Simples Nacional sem permissão de crédito"},
         ])
         df.to_excel(CURRENT_DIR / FILES["cst"], index=False)
+    _ensured = True
 
 
 def _read_excel(path: Path) -> pd.DataFrame:
@@ -71,6 +113,24 @@ def _norm_cols(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
+def tables_signature() -> str:
+    """Content hash of the current Base Legal files (key for shared caches; memoized by file mtime/size)."""
+    ensure_base_legal()
+    h = hashlib.sha1()
+    for key, fname in FILES.items():
+        p = CURRENT_DIR / fname
+        h.update(key.encode())
+        if not p.exists():
+            continue
+        st = p.stat()
+        sig = (st.st_mtime_ns, st.st_size)
+        cached = _DIGEST_CACHE.get(key)
+        if cached is None or cached[0] != sig:
+            cached = _DIGEST_CACHE[key] = (sig, hashlib.sha1(p.read_bytes()).digest())
+        h.update(cached[1])
+    return h.hexdigest()
+
+
 def load_tables() -> Dict[str, pd.DataFrame]:
     """Load base legal tables. Always returns keys ncm/cfop/cst (possibly empty)."""
     ensure_base_legal()
@@ -115,14 +175,24 @@ def save_uploaded_table(key: str, uploaded_bytes: bytes) -> BaseLegalStatus:
 
         # Backup current (if exists)
         cur_path = CURRENT_DIR / fname
+        diff = None
+        if cur_path.exists():
+            try:
+                diff = diff_tables(key, load_version(cur_path), df)
+            except Exception:
+                diff = None
         ts = pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")
         if cur_path.exists():
             backup = HISTORY_DIR / f"{ts}__{fname}"
+            n = 1
+            while backup.exists():  # same second: never overwrite an older backup
+                backup = HISTORY_DIR / f"{ts}_{n}__{fname}"
+                n += 1
             cur_path.replace(backup)
 
         # Move tmp into place
         tmp_path.replace(cur_path)
-        return BaseLegalStatus(ok=True, message="Base atualizada com sucesso.", rows=len(df), path=str(cur_path))
+        return BaseLegalStatus(ok=True, message="Base atualizada com sucesso.", rows=len(df), path=str(cur_path), diff=diff)
     except Exception as e:
         try:
             tmp_path.unlink(missing_ok=True)
@@ -131,8 +201,21 @@ def save_uploaded_table(key: str, uploaded_bytes: bytes) -> BaseLegalStatus:
         return BaseLegalStatus(ok=False, message=f"Falha ao salvar/ler Excel: {e}")
 
 
+def _count_rows(path: Path) -> int:
+    """Data rows (header excluded) of the first sheet, streamed with openpyxl."""
+    from openpyxl import load_workbook
+
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        n = sum(1 for row in ws.iter_rows(values_only=True) if any(v not in (None, "") for v in row))
+    finally:
+        wb.close()
+    return max(n - 1, 0)
+
+
 def get_status() -> Dict[str, BaseLegalStatus]:
-    """Return basic status about current base files."""
+    """Return basic status about current base files (memoized by file mtime/size)."""
     ensure_base_legal()
     out: Dict[str, BaseLegalStatus] = {}
     for key, fname in FILES.items():
@@ -140,9 +223,93 @@ def get_status() -> Dict[str, BaseLegalStatus]:
         if not p.exists():
             out[key] = BaseLegalStatus(ok=False, message="Arquivo não encontrado.")
             continue
+        st = p.stat()
+        sig = (st.st_mtime_ns, st.st_size)
+        cached = _STATUS_CACHE.get(key)
+        if cached is not None and cached[0] == sig:
+            out[key] = cached[1]
+            continue
         try:
-            df = pd.read_excel(p, dtype=str)
-            out[key] = BaseLegalStatus(ok=True, message="OK", rows=len(df), path=str(p))
+            out[key] = BaseLegalStatus(ok=True, message="OK", rows=_count_rows(p), path=str(p))
         except Exception as e:
             out[key] = BaseLegalStatus(ok=False, message=f"Erro ao ler: {e}", path=str(p))
+        _STATUS_CACHE[key] = (sig, out[key])
     return out
+
+
+# --- Versions / diff (incremental revalidation) ---
+
+def list_history(key: str) -> List[Path]:
+    """Backups of a table in HISTORY_DIR, oldest first (names start with a timestamp)."""
+    fname = FILES[key]
+    if not HISTORY_DIR.exists():
+        return []
+    return sorted(HISTORY_DIR.glob(f"*__{fname}"), key=_backup_order)
+
+
+def _backup_order(path: Path) -> Tuple[str, int]:
+    # "<ts>__f.xlsx" then "<ts>_1__f.xlsx", "<ts>_2__f.xlsx" (same-second saves)
+    stamp = path.name.split("__", 1)[0]
+    n = stamp[16:]
+    return stamp[:15], int(n) if n.isdigit() else 0
+
+
+def load_version(path: Path) -> pd.DataFrame:
+    """Load any version (current or backup) of a table with normalized columns."""
+    return _norm_cols(_read_excel(Path(path)))
+
+
+def table_codes(key: str, df: pd.DataFrame) -> Dict[str, Dict[str, str]]:
+    """
+    Map lookup group -> {normalized code: row signature}.
+    Groups: NCM, CFOP, CST and CSOSN (the same sets `validar_itens` builds).
+    """
+    groups: Dict[str, Dict[str, str]] = {}
+    if df is None or df.empty:
+        return groups
+    df = _norm_cols(df).fillna("").astype(str)
+    other = sorted(c for c in df.columns if c not in ("ncm", "cfop", "codigo", "tipo"))
+    sig = df[other].apply(lambda r: "\x1f".join(v.strip() for v in r), axis=1) if other else pd.Series("", index=df.index)
+
+    if key in ("ncm", "cfop") and key in df.columns:
+        width = 8 if key == "ncm" else 4
+        codes = df[key].str.replace(r"\D", "", regex=True).str.zfill(width)
+        groups[key.upper()] = dict(zip(codes, sig))
+    elif key == "cst" and {"codigo", "tipo"}.issubset(df.columns):
+        tipo = df["tipo"].str.upper().str.strip()
+        codigo = df["codigo"].str.strip()
+        for t in ("CST", "CSOSN"):
+            mask = tipo == t
+            groups[t] = dict(zip(t + ":" + codigo[mask], sig[mask]))
+    return groups
+
+
+def diff_tables(key: str, old: pd.DataFrame, new: pd.DataFrame) -> BaseLegalDiff:
+    """Diff two versions of a table by normalized code."""
+    old_g = table_codes(key, old)
+    new_g = table_codes(key, new)
+    diff = BaseLegalDiff(key=key)
+    for group in set(old_g) | set(new_g):
+        o = old_g.get(group, {})
+        n = new_g.get(group, {})
+        if bool(o) != bool(n):
+            diff.toggled.add(group)
+        diff.added |= set(n) - set(o)
+        diff.removed |= set(o) - set(n)
+        diff.changed |= {c for c in set(o) & set(n) if o[c] != n[c]}
+    return diff
+
+
+def diff_versions(key: str, old_path: Optional[Path] = None, new_path: Optional[Path] = None) -> BaseLegalDiff:
+    """
+    Diff two stored versions of a table. Defaults: latest backup in HISTORY_DIR
+    against the current file.
+    """
+    if new_path is None:
+        new_path = CURRENT_DIR / FILES[key]
+    if old_path is None:
+        history = list_history(key)
+        if not history:
+            return BaseLegalDiff(key=key)
+        old_path = history[-1]
+    return diff_tables(key, load_version(old_path), load_version(new_path))
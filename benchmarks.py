@@ -0,0 +1,162 @@
+"""
+Micro-benchmarks for the ingest/validation pipeline.
+
+Run from the app folder:  python -m utils.benchmarks [--notas 500] [--itens 10] [--startup]
+Synthetic NF-e are generated in memory; numbers are wall-clock seconds.
+`--saida FILE` appends the results as one JSON line, to track them over time.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+NS = "http://www.portalfiscal.inf.br/nfe"
+
+
+def gerar_nfe(i: int, n_itens: int = 10, ncm: str = "12345678", cfop: str = "5102",
+              cst: str = "00", csosn: str = "", preco: float = 10.0,
+              emit_cnpj: str = "11222333000181", dh_emi: str = "2024-01-15T10:00:00-03:00") -> bytes:
+    """Build a synthetic nfeProc (structurally close to a real note, not schema-complete)."""
+    dets = []
+    for k in range(1, n_itens + 1):
+        if csosn:
+            icms = f"<ICMSSN102><orig>0</orig><CSOSN>{csosn}</CSOSN></ICMSSN102>"
+        else:
+            icms = (f"<ICMS00><orig>0</orig><CST>{cst}</CST><modBC>0</modBC><vBC>{preco:.2f}</vBC>"
+                    f"<pICMS>18.00</pICMS><vICMS>{preco * 0.18:.2f}</vICMS></ICMS00>")
+        dets.append(
+            f'<det nItem="{k}"><prod><cProd>P{k:05d}</cProd><xProd>PRODUTO {k}</xProd><NCM>{ncm}</NCM>'
+            f"<CFOP>{cfop}</CFOP><uCom>UN</uCom><qCom>1.0000</qCom><vUnCom>{preco:.4f}</vUnCom>"
+            f"<vProd>{preco:.2f}</vProd></prod><imposto><ICMS>{icms}</ICMS></imposto></det>"
+        )
+    chave = f"{i:044d}"
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?><nfeProc xmlns="{NS}" versao="4.00"><NFe xmlns="{NS}">'
+        f'<infNFe Id="NFe{chave}" versao="4.00"><ide><nNF>{i}</nNF><serie>1</serie><dhEmi>{dh_emi}</dhEmi></ide>'
+        f"<emit><CNPJ>{emit_cnpj}</CNPJ><xNome>EMITENTE</xNome></emit>"
+        f"<dest><CNPJ>99888777000100</CNPJ><xNome>DESTINATARIO</xNome></dest>" + "".join(dets) +
+        f"<total><ICMSTot><vNF>{preco * n_itens:.2f}</vNF></ICMSTot></total></infNFe></NFe></nfeProc>"
+    ).encode("utf-8")
+
+
+def _timeit(fn: Callable[[], object]) -> float:
+    t0 = time.perf_counter()
+    fn()
+    return time.perf_counter() - t0
+
+
+def bench_pipeline(n_notas: int = 500, n_itens: int = 10) -> List[Tuple[str, float]]:
+    import pandas as pd
+
+    from .nfe_parser import parse_nfe_xml
+    from .schema_validator import clear_cache, executor, schema_disponivel, validar_schema
+    from .anomalias import detectar_anomalias
+    from .validator import validar_itens, validar_itens_compacto
+
+    payloads = [(f"nfe_{i}.xml", gerar_nfe(i, n_itens)) for i in range(n_notas)]
+    results: List[Tuple[str, float]] = []
+
+    parsed: List[Dict] = []
+    results.append(("parse", _timeit(lambda: parsed.extend(parse_nfe_xml(p) for _, p in payloads))))
+
+    if schema_disponivel():
+        clear_cache()
+        results.append(("xsd: compilação (1ª nota)", _timeit(lambda: validar_schema(payloads[0][1]))))
+        results.append(("xsd: serial (cache quente)", _timeit(lambda: [validar_schema(p, f) for f, p in payloads])))
+
+        def parse_com_xsd():
+            futs = [executor().submit(validar_schema, p, f) for f, p in payloads]
+            for _, p in payloads:
+                parse_nfe_xml(p)
+            for fut in futs:
+                fut.result()
+
+        results.append(("parse + xsd paralelo (compila por worker)", _timeit(parse_com_xsd)))
+        results.append(("parse + xsd paralelo (workers quentes)", _timeit(parse_com_xsd)))
+    else:
+        results.append(("xsd: indisponível (lxml/schemas ausentes)", float("nan")))
+
+    rows = [dict(p["header"], **it) for p in parsed for it in p["items"]]
+    df_itens = pd.DataFrame(rows)
+    tables = {
+        "ncm": pd.DataFrame({"ncm": ["12345678"], "descricao": ["x"]}),
+        "cfop": pd.DataFrame({"cfop": ["5102"], "descricao": ["x"]}),
+        "cst": pd.DataFrame({"codigo": ["00"], "tipo": ["CST"], "descricao": ["x"]}),
+    }
+    results.append(("validar_itens", _timeit(lambda: validar_itens(df_itens, tables))))
+    results.append(("validar_itens_compacto", _timeit(lambda: validar_itens_compacto(df_itens, tables))))
+    results.append(("detectar_anomalias (preços)", _timeit(lambda: detectar_anomalias(df_itens))))
+    return results
+
+
+# Runs in a fresh interpreter (cold process) next to app.py
+_STARTUP_SNIPPET = r"""
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+
+HEAVY = ("pandas", "numpy", "pyarrow", "openpyxl", "xlsxwriter", "lxml")
+out = {}
+before = set(sys.modules)
+at = AppTest.from_file("app.py", default_timeout=120)
+t0 = time.perf_counter(); at.run(); out["login: 1ª renderização"] = time.perf_counter() - t0
+out["login: módulos pesados carregados"] = sorted({m.split(".")[0] for m in set(sys.modules) - before} & set(HEAVY))
+t0 = time.perf_counter(); at.run(); out["login: rerun"] = time.perf_counter() - t0
+at.session_state["auth"] = {"username": "bench", "role": "user"}
+t0 = time.perf_counter(); at.run(); out["logado: 1ª renderização"] = time.perf_counter() - t0
+t0 = time.perf_counter(); at.run(); out["logado: rerun"] = time.perf_counter() - t0
+out["erros"] = [e.message for e in at.exception]
+print(json.dumps(out))
+"""
+
+
+def bench_startup() -> List[Tuple[str, object]]:
+    """Time-to-first-paint and per-rerun overhead of app.py, measured in a cold process."""
+    app_dir = Path(__file__).resolve().parents[1]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(app_dir), os.environ.get("PYTHONPATH")])))
+    t0 = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", _STARTUP_SNIPPET], cwd=str(app_dir), env=env,
+                          capture_output=True, text=True)
+    total = time.perf_counter() - t0
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "falha no benchmark")
+    results: List[Tuple[str, object]] = [("processo: total (import + 4 execuções)", total)]
+    results.extend(json.loads(proc.stdout.strip().splitlines()[-1]).items())
+    return results
+
+
+def main(argv=None) -> None:
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--notas", type=int, default=500)
+    ap.add_argument("--itens", type=int, default=10)
+    ap.add_argument("--startup", action="store_true", help="Mede também a inicialização do app (login/rerun)")
+    ap.add_argument("--saida", metavar="ARQUIVO", help="Acrescenta os resultados como uma linha JSON")
+    args = ap.parse_args(argv)
+
+    registro: Dict[str, object] = {"ts": time.strftime("%Y-%m-%dT%H:%M:%S"), "notas": args.notas, "itens": args.itens}
+    print(f"{args.notas} nota(s) x {args.itens} item(ns)")
+    for nome, seg in bench_pipeline(args.notas, args.itens):
+        print(f"  {nome:<45} {seg:8.3f}s")
+        registro[nome] = seg
+
+    if args.startup:
+        print("inicialização do app")
+        for nome, valor in bench_startup():
+            if isinstance(valor, float):
+                print(f"  {nome:<45} {valor:8.3f}s")
+            else:
+                print(f"  {nome:<45} {valor}")
+            registro[nome] = valor
+
+    if args.saida:
+        with open(args.saida, "a", encoding="utf-8") as f:
+            f.write(json.dumps(registro, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import io
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Hashable, Iterator, Optional, Tuple
+
+MB = 1024 * 1024
+
+
+def _env_mb(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default)) * MB
+    except ValueError:
+        return default * MB
+
+
+# Limits (override via env, in MB / count)
+SHARED_MAX_BYTES = _env_mb("NFE_CACHE_SHARED_MB", 512)
+SESSION_BUDGET_BYTES = _env_mb("NFE_SESSION_BUDGET_MB", 256)
+MIN_FREE_BYTES = _env_mb("NFE_MIN_FREE_MB", 512)
+MAX_PIPELINES = int(os.environ.get("NFE_MAX_PIPELINES", "2"))
+ADMISSION_WAIT_S = float(os.environ.get("NFE_ADMISSION_WAIT_S", "60"))
+
+
+def tamanho(obj: Any) -> int:
+    """Approximate in-memory size of a cached object (DataFrames, buffers, containers)."""
+    memory_usage = getattr(obj, "memory_usage", None)
+    if callable(memory_usage):  # pandas DataFrame / Series
+        try:
+            usage = memory_usage(deep=True)
+            return int(usage.sum()) if hasattr(usage, "sum") else int(usage)
+        except Exception:
+            pass
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return len(obj)
+    if isinstance(obj, io.BytesIO):
+        return obj.getbuffer().nbytes
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(tamanho(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(tamanho(v) for v in obj)
+    if hasattr(obj, "__dict__") and not isinstance(obj, type):
+        return sys.getsizeof(obj) + tamanho(vars(obj))
+    return sys.getsizeof(obj)
+
+
+def memoria_disponivel() -> Optional[int]:
+    """
+    Free memory for this container/host in bytes: cgroup v2/v1 limit minus
+    usage when a limit is set, else MemAvailable from /proc/meminfo.
+    None when it cannot be determined.
+    """
+    livres = []
+    for limit_f, usage_f in (
+        ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+        ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes"),
+    ):
+        try:
+            limit = Path(limit_f).read_text().strip()
+            usage = int(Path(usage_f).read_text().strip())
+        except (OSError, ValueError):
+            continue
+        if limit.isdigit() and int(limit) < (1 << 60):
+            livres.append(int(limit) - usage)
+        break
+    try:
+        with open("/proc/meminfo", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    livres.append(int(line.split()[1]) * 1024)
+                    break
+    except (OSError, ValueError):
+        pass
+    return min(livres) if livres else None
+
+
+class SharedCache:
+    """
+    Process-wide cache of immutable objects keyed by content hash (Base Legal
+    tables, parsed uploads...). Objects are shared by every session, so
+    callers must not mutate them. LRU-evicted beyond `max_bytes`; a per-key
+    lock makes concurrent requests for the same key build it only once.
+    """
+
+    def __init__(self, max_bytes: int = SHARED_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._building: Dict[Hashable, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: Hashable, obj: Any) -> Any:
+        size = tamanho(obj)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._items[key] = (obj, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and len(self._items) > 1:
+                _, (_, s) = self._items.popitem(last=False)
+                self._bytes -= s
+        return obj
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        obj = self.get(key)
+        if obj is not None:
+            return obj
+        with self._lock:
+            build_lock = self._building.setdefault(key, threading.Lock())
+        with build_lock:
+            obj = self.get(key)  # built by another session while we waited
+            if obj is not None:
+                return obj
+            self.misses += 1
+            try:
+                return self.put(key, factory())
+            finally:
+                with self._lock:
+                    self._building.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"itens": len(self._items), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+
+class SessionBudget:
+    """
+    Per-session store of derived artifacts (Excel/Parquet buffers, findings,
+    consolidations) with a memory budget: least recently used artifacts are
+    evicted and simply rebuilt on demand.
+    """
+
+    def __init__(self, budget_bytes: int = SESSION_BUDGET_BYTES):
+        self.budget_bytes = budget_bytes
+        self._items: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._bytes = 0
+
+    def get(self, name: Hashable) -> Any:
+        item = self._items.get(name)
+        if item is None:
+            return None
+        self._items.move_to_end(name)
+        return item[0]
+
+    def put(self, name: Hashable, obj: Any) -> Any:
+        self.discard(name)
+        size = tamanho(obj)
+        self._items[name] = (obj, size)
+        self._bytes += size
+        while self._bytes > self.budget_bytes and len(self._items) > 1:
+            _, (_, s) = self._items.popitem(last=False)
+            self._bytes -= s
+        return obj
+
+    def get_or_create(self, name: Hashable, factory: Callable[[], Any]) -> Any:
+        obj = self.get(name)
+        return obj if obj is not None else self.put(name, factory())
+
+    def discard(self, name: Hashable) -> None:
+        item = self._items.pop(name, None)
+        if item is not None:
+            self._bytes -= item[1]
+
+    @property
+    def bytes(self) -> int:
+        return self._bytes
+
+
+class AdmissionRejected(RuntimeError):
+    pass
+
+
+class AdmissionController:
+    """
+    Gate for heavy pipelines: at most `max_concurrent` run at once, and a new
+    one only starts when the host has `min_free_bytes` plus its estimated
+    footprint available. Callers wait up to `wait_s` and are then rejected.
+    """
+
+    def __init__(self, max_concurrent: int = MAX_PIPELINES, min_free_bytes: int = MIN_FREE_BYTES,
+                 wait_s: float = ADMISSION_WAIT_S):
+        self.min_free_bytes = min_free_bytes
+        self.wait_s = wait_s
+        self._slots = threading.BoundedSemaphore(max(1, max_concurrent))
+        self.running = 0
+        self.rejected = 0
+
+    def _memoria_ok(self, estimativa: int) -> bool:
+        livre = memoria_disponivel()
+        return livre is None or livre - estimativa >= self.min_free_bytes
+
+    @contextmanager
+    def admitir(self, estimativa: int = 0) -> Iterator[None]:
+        deadline = time.monotonic() + self.wait_s
+        if not self._slots.acquire(timeout=self.wait_s):
+            self.rejected += 1
+            raise AdmissionRejected("Muitos processamentos em andamento. Tente novamente em instantes.")
+        try:
+            while not self._memoria_ok(estimativa):
+                if time.monotonic() >= deadline:
+                    self.rejected += 1
+                    raise AdmissionRejected("Memória do servidor insuficiente no momento. Tente novamente em instantes.")
+                time.sleep(0.5)
+            self.running += 1
+            try:
+                yield
+            finally:
+                self.running -= 1
+        finally:
+            self._slots.release()
+
+
+# Process-wide singletons (utils modules are imported once per process)
+shared_cache = SharedCache()
+admissao = AdmissionController()
@@ -0,0 +1,260 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import pickle
+import re
+import shutil
+import time
+import zipfile
+import zlib
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from xml.etree.ElementTree import ParseError
+
+import pandas as pd
+
+try:  # optional dependency: without pyarrow, parts are pickled instead of Parquet
+    import pyarrow  # noqa: F401
+except Exception:  # pragma: no cover
+    pyarrow = None
+
+BASE_DIR = Path(__file__).resolve().parents[2]  # project root (agente_leitor_xml_fiscal)
+CHECKPOINTS_DIR = BASE_DIR / "data" / "checkpoints"
+
+DATASETS = ("notas", "itens", "achados", "agregado")
+MANIFEST = "manifest.jsonl"
+QUARANTINE = "quarentena.jsonl"
+PART_SUFFIXES = (".parquet", ".pkl")
+
+_ENCODING_RE = re.compile(rb"""^(?:\xef\xbb\xbf)?\s*<\?xml[^>]*?encoding\s*=\s*["']([A-Za-z0-9._-]+)["']""")
+
+# Partial aggregates are kept at the finest consolidation grain; any
+# "Consolidar por" choice is a roll-up of these columns.
+AGG_KEYS = ["xProd", "cProd", "NCM", "CFOP"]
+
+
+def sha256(payload: bytes) -> str:
+    return hashlib.sha256(payload).hexdigest()
+
+
+def erro_codificacao(payload: bytes) -> Optional[str]:
+    """
+    Reason when the bytes do not decode with the encoding the XML declares
+    (UTF-8 when undeclared), else None. The parser only reports these as
+    "not well-formed (invalid token)".
+    """
+    m = _ENCODING_RE.match(payload[:200])
+    enc = m.group(1).decode("ascii") if m else "utf-8"
+    inicio = 3 if payload.startswith(b"\xef\xbb\xbf") else 0  # a BOM forces UTF-8
+    if inicio:
+        enc = "utf-8"
+    try:
+        payload[inicio:].decode(enc)
+    except LookupError:
+        return f"codificação declarada desconhecida: {enc}"
+    except UnicodeDecodeError as e:
+        pos = inicio + e.start
+        return f"conteúdo não é {enc} válido (byte 0x{payload[pos]:02x} na posição {pos})"
+    return None
+
+
+def classificar_erro(e: BaseException, payload: Optional[bytes] = None) -> str:
+    """Short quarantine reason for a member that could not be ingested."""
+    msg = str(e)
+    if isinstance(e, UnicodeError) or "encoding" in msg.lower():
+        return f"codificacao: {msg}"
+    if isinstance(e, ParseError):
+        cod = erro_codificacao(payload) if isinstance(payload, bytes) else None
+        if cod:
+            return f"codificacao: {cod}"
+        if "no element found" in msg or "unclosed token" in msg:
+            return f"truncado: {msg}"
+        return f"xml_invalido: {msg}"
+    if isinstance(e, ValueError) and "infNFe" in msg:
+        return f"nao_nfe: {msg}"
+    if isinstance(e, (zipfile.BadZipFile, zlib.error, EOFError)):
+        return f"membro_corrompido: {msg}"
+    return f"{type(e).__name__}: {msg}"
+
+
+def agregado_parcial(df_itens: pd.DataFrame) -> pd.DataFrame:
+    """Sums per AGG_KEYS; mergeable across batches (mean = soma_vUnCom / n_vUnCom)."""
+    df = df_itens.copy()
+    for c in AGG_KEYS:
+        if c not in df.columns:
+            df[c] = ""
+    for c in ("qCom", "vProd", "vUnCom"):
+        if c not in df.columns:
+            df[c] = float("nan")
+    return (
+        df.groupby(AGG_KEYS, dropna=False, as_index=False)
+        .agg(
+            quantidade=("qCom", "sum"),
+            valor_total=("vProd", "sum"),
+            soma_vUnCom=("vUnCom", "sum"),
+            n_vUnCom=("vUnCom", "count"),
+        )
+    )
+
+
+def consolidar(parciais: pd.DataFrame, key_cols: List[str]) -> pd.DataFrame:
+    """Roll partial aggregates up to `key_cols` (same output as the app's Consolidado)."""
+    if parciais.empty:
+        return pd.DataFrame(columns=key_cols + ["quantidade", "valor_total", "valor_unit_medio"])
+    agg = parciais.groupby(key_cols, dropna=False, as_index=False)[
+        ["quantidade", "valor_total", "soma_vUnCom", "n_vUnCom"]
+    ].sum()
+    agg["valor_unit_medio"] = agg["soma_vUnCom"] / agg["n_vUnCom"].where(agg["n_vUnCom"] > 0)
+    return agg.drop(columns=["soma_vUnCom", "n_vUnCom"]).sort_values(["valor_total"], ascending=False)
+
+
+def _fsync_write(path: Path, data: bytes) -> None:
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _serializar(df: pd.DataFrame) -> bytes:
+    if pyarrow is not None:
+        return df.to_parquet(index=False)
+    return pickle.dumps(df.reset_index(drop=True), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _ler_parte(path: Path) -> pd.DataFrame:
+    # .pkl parts are only ever written by this module (trusted local files)
+    return pd.read_parquet(path) if path.suffix == ".parquet" else pd.read_pickle(path)
+
+
+class Checkpoint:
+    """
+    Durable progress for one ingest job.
+
+    Each committed batch writes its part files first (atomically) and then
+    appends ONE manifest line listing the members it covers, so a crash at
+    any point leaves either a fully committed batch or nothing (orphan parts
+    are overwritten when the batch is redone). Members already in the
+    manifest with the same content hash are skipped on resume; quarantined
+    members are recorded and never retried.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.parts_dir = self.path / "partes"
+        self.parts_dir.mkdir(parents=True, exist_ok=True)
+        self._feitos: Set[Tuple[str, str]] = set()
+        self._partes: List[int] = []
+        self.quarentena: List[Dict[str, str]] = []
+        self._load()
+
+    @classmethod
+    def for_upload(cls, assinatura: str, root: Path = CHECKPOINTS_DIR) -> "Checkpoint":
+        """Checkpoint keyed by the upload's content signature (same upload -> same job)."""
+        return cls(Path(root) / assinatura)
+
+    def _load(self) -> None:
+        mf = self.path / MANIFEST
+        if not mf.exists():
+            return
+        raw = mf.read_bytes()
+        if raw and not raw.endswith(b"\n"):
+            # Crash mid-append: drop the torn line so new lines start clean
+            raw = raw[: raw.rfind(b"\n") + 1]
+            with open(mf, "r+b") as f:
+                f.truncate(len(raw))
+        for line in raw.decode("utf-8").splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            self._partes.append(int(entry["parte"]))
+            for nome, h in entry.get("membros", []):
+                self._feitos.add((nome, h))
+            for q in entry.get("quarentena", []):
+                self._feitos.add((q["membro"], q["sha256"]))
+                self.quarentena.append(q)
+
+    @property
+    def n_membros(self) -> int:
+        return len(self._feitos)
+
+    def ja_processado(self, nome: str, h: str) -> bool:
+        return (nome, h) in self._feitos
+
+    def _part_path(self, dataset: str, parte: int) -> Path:
+        """Existing part file (.parquet or .pkl) or, if none, where to write a new one."""
+        base = self.parts_dir / f"{dataset}-{parte:05d}"
+        for suffix in PART_SUFFIXES:
+            if base.with_suffix(suffix).exists():
+                return base.with_suffix(suffix)
+        return base.with_suffix(".parquet" if pyarrow is not None else ".pkl")
+
+    def commit(self, frames: Dict[str, pd.DataFrame], membros: List[Tuple[str, str]],
+               quarentena: List[Dict[str, str]]) -> int:
+        """Persist one batch (part files + manifest line). Returns the part number."""
+        parte = (max(self._partes) + 1) if self._partes else 1
+        for dataset, df in frames.items():
+            if df is not None and not df.empty:
+                for orfa in (self.parts_dir / f"{dataset}-{parte:05d}{sfx}" for sfx in PART_SUFFIXES):
+                    orfa.unlink(missing_ok=True)  # left by a batch that crashed before its manifest line
+                _fsync_write(self._part_path(dataset, parte), _serializar(df))
+        line = json.dumps({"parte": parte, "membros": membros, "quarentena": quarentena,
+                           "ts": time.time()}, ensure_ascii=False) + "\n"
+        with open(self.path / MANIFEST, "a", encoding="utf-8") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        if quarentena:
+            with open(self.path / QUARANTINE, "a", encoding="utf-8") as f:
+                for q in quarentena:
+                    f.write(json.dumps(q, ensure_ascii=False) + "\n")
+        self._partes.append(parte)
+        self._feitos.update((n, h) for n, h in membros)
+        self._feitos.update((q["membro"], q["sha256"]) for q in quarentena)
+        self.quarentena.extend(quarentena)
+        return parte
+
+    def iter_partes(self, dataset: str) -> Iterator[pd.DataFrame]:
+        """Committed parts of one dataset, in order, one at a time."""
+        for parte in sorted(self._partes):
+            p = self._part_path(dataset, parte)
+            if p.exists():
+                yield _ler_parte(p)
+
+    def iter_lotes(self) -> Iterator[Dict[str, pd.DataFrame]]:
+        """Committed batches in order, as {dataset: frame} (missing datasets are empty)."""
+        for parte in sorted(self._partes):
+            out = {}
+            for dataset in DATASETS:
+                p = self._part_path(dataset, parte)
+                out[dataset] = _ler_parte(p) if p.exists() else pd.DataFrame()
+            yield out
+
+    def carregar(self, dataset: str) -> pd.DataFrame:
+        frames = list(self.iter_partes(dataset))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    def consolidado(self, key_cols: List[str]) -> pd.DataFrame:
+        return consolidar(self.carregar("agregado"), key_cols)
+
+    def remover(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def limpar_antigos(root: Path = CHECKPOINTS_DIR, dias: float = 7) -> None:
+    """Remove checkpoints not touched in `dias` days."""
+    if not Path(root).exists():
+        return
+    limite = time.time() - dias * 86400
+    for d in Path(root).iterdir():
+        try:
+            mf = d / MANIFEST
+            mtime = (mf if mf.exists() else d).stat().st_mtime
+            if d.is_dir() and mtime < limite:
+                shutil.rmtree(d, ignore_errors=True)
+        except OSError:
+            pass
@@ -0,0 +1,213 @@
+"""
+Headless ingest: read NF-e XMLs (files, folders or ZIPs), validate and export.
+
+Run from the app folder:
+    python -m utils.ingest notas.zip pasta_xml/ --parquet saida_parquet/
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+import zipfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import pandas as pd
+
+from .nfe_parser import parse_nfe_xml
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .checkpoint import Checkpoint
+
+NUMERIC_COLS = ["qCom", "vUnCom", "vProd", "pICMS", "vICMS", "vNF"]
+
+
+def converter_numericos(df_itens: pd.DataFrame) -> pd.DataFrame:
+    """Best-effort numeric conversion (accepts comma as decimal separator). In place."""
+    for c in NUMERIC_COLS:
+        if c in df_itens.columns:
+            df_itens[c] = pd.to_numeric(
+                df_itens[c].astype(str).str.replace(",", ".", regex=False),
+                errors="coerce",
+            )
+    return df_itens
+
+
+def linhas_nota(fname: str, payload: bytes) -> Tuple[Dict[str, str], List[Dict[str, str]]]:
+    """Parse one XML; returns (header, item rows with the header fields merged in)."""
+    parsed = parse_nfe_xml(payload)
+    h = parsed["header"]
+    h["arquivo"] = fname
+    rows = []
+    for it in parsed["items"]:
+        row = {}
+        row.update(h)  # include header fields for traceability
+        row.update(it)
+        rows.append(row)
+    return h, rows
+
+
+def iter_xml_payloads(paths: Iterable, tolerante: bool = False) -> Iterator[Tuple[str, Union[bytes, Exception]]]:
+    """
+    Yield (name, bytes) for every .xml in the given files/folders/ZIPs, one member at a time.
+    With `tolerante=True`, a member (or ZIP) that cannot be read is yielded as
+    (name, exception) instead of aborting the whole iteration.
+    """
+    for p in paths:
+        p = Path(p)
+        if p.is_dir():
+            yield from iter_xml_payloads(sorted(c for c in p.rglob("*") if c.is_file()), tolerante)
+        elif p.suffix.lower() == ".zip":
+            try:
+                zf = zipfile.ZipFile(p)
+            except Exception as e:
+                if not tolerante:
+                    raise
+                yield p.name, e
+                continue
+            with zf:
+                for zi in zf.infolist():
+                    if not zi.filename.lower().endswith(".xml"):
+                        continue
+                    try:
+                        data = zf.read(zi)
+                    except Exception as e:
+                        if not tolerante:
+                            raise
+                        yield f"{p.name}/{zi.filename}", e
+                        continue
+                    yield f"{p.name}/{zi.filename}", data
+        elif p.suffix.lower() == ".xml":
+            yield p.name, p.read_bytes()
+
+
+@dataclass
+class Lote:
+    notas: pd.DataFrame
+    itens: pd.DataFrame
+    achados: pd.DataFrame
+    erros: List[Tuple[str, str]] = field(default_factory=list)  # (membro, motivo) = quarantined
+    membros: List[Tuple[str, str]] = field(default_factory=list)  # (membro, sha256) ingested
+
+
+def processar_lotes(payloads: Iterable[Tuple[str, Union[bytes, Exception]]],
+                    tables: Optional[Dict[str, pd.DataFrame]] = None,
+                    tamanho_lote: int = 1000,
+                    checkpoint: Optional["Checkpoint"] = None) -> Iterator[Lote]:
+    """
+    Parse (and validate, when `tables` is given) payloads in batches of
+    `tamanho_lote` XMLs, so memory stays bounded on large archives.
+
+    With a `checkpoint`, members already committed (same name and content
+    hash) are skipped and every batch is committed before it is yielded;
+    members that fail to read/parse are quarantined with their reason.
+    """
+    from .checkpoint import agregado_parcial, classificar_erro, sha256
+    from .validator import validar_itens
+
+    def flush(headers, rows, quarentena, membros) -> Lote:
+        df_itens = converter_numericos(pd.DataFrame(rows))
+        notas = converter_numericos(pd.DataFrame(headers))
+        achados = validar_itens(df_itens, tables) if tables is not None and not df_itens.empty else pd.DataFrame()
+        erros = [(q["membro"], q["motivo"]) for q in quarentena]
+        lote = Lote(notas=notas, itens=df_itens, achados=achados, erros=erros, membros=membros)
+        if checkpoint is not None:
+            checkpoint.commit(
+                {"notas": notas, "itens": df_itens, "achados": achados,
+                 "agregado": agregado_parcial(df_itens) if not df_itens.empty else None},
+                membros,
+                quarentena,
+            )
+        return lote
+
+    headers: List[Dict[str, str]] = []
+    rows: List[Dict[str, str]] = []
+    quarentena: List[Dict[str, str]] = []
+    membros: List[Tuple[str, str]] = []
+    n = 0
+    for fname, payload in payloads:
+        h = sha256(payload) if isinstance(payload, bytes) else ""
+        if checkpoint is not None and checkpoint.ja_processado(fname, h):
+            continue
+        try:
+            if isinstance(payload, Exception):
+                raise payload
+            nota, r = linhas_nota(fname, payload)
+            headers.append(nota)
+            rows.extend(r)
+            membros.append((fname, h))
+        except Exception as e:
+            quarentena.append({"membro": fname, "sha256": h, "motivo": classificar_erro(e, payload)})
+        n += 1
+        if n >= tamanho_lote:
+            yield flush(headers, rows, quarentena, membros)
+            headers, rows, quarentena, membros, n = [], [], [], [], 0
+    if n:
+        yield flush(headers, rows, quarentena, membros)
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Ingestão headless de NF-e (XML/ZIP/pastas).")
+    ap.add_argument("entradas", nargs="+", help="Arquivos .xml, .zip ou pastas")
+    ap.add_argument("--parquet", metavar="DIR", help="Exporta notas/itens/achados em Parquet particionado")
+    ap.add_argument("--sobrescrever", action="store_true",
+                    help="Apaga notas/itens/achados já existentes na pasta do --parquet antes de gravar")
+    ap.add_argument("--sem-validacao", action="store_true", help="Não executa a validação fiscal (Base Legal)")
+    ap.add_argument("--lote", type=int, default=1000, help="XMLs por lote (default: 1000)")
+    ap.add_argument("--checkpoint", metavar="DIR",
+                    help="Grava progresso em DIR; rodar de novo com o mesmo DIR retoma de onde parou")
+    args = ap.parse_args(argv)
+
+    tables = None
+    if not args.sem_validacao:
+        from .base_legal import load_tables
+        tables = load_tables()
+
+    ckpt = None
+    if args.checkpoint:
+        from .checkpoint import Checkpoint
+        ckpt = Checkpoint(args.checkpoint)
+        if ckpt.n_membros:
+            print(f"Retomando: {ckpt.n_membros} membro(s) já processado(s).", file=sys.stderr)
+
+    # With a checkpoint, Parquet is written from the committed parts at the
+    # end: a crash mid-run would otherwise leave unreadable open files.
+    exporter = None
+    if args.parquet:
+        from .parquet_export import ParquetExporter
+        try:
+            exporter = ParquetExporter(args.parquet, sobrescrever=args.sobrescrever)
+        except FileExistsError as e:
+            ap.error(f"{e}; use outra pasta ou --sobrescrever")
+
+    n_notas = n_itens = n_achados = n_erros = 0
+    try:
+        payloads = iter_xml_payloads(args.entradas, tolerante=True)
+        for lote in processar_lotes(payloads, tables, args.lote, checkpoint=ckpt):
+            if exporter is not None and ckpt is None:
+                exporter.write(notas=lote.notas, itens=lote.itens, achados=lote.achados)
+            for fname, motivo in lote.erros:
+                print(f"Quarentena {fname}: {motivo}", file=sys.stderr)
+            n_notas += len(lote.notas)
+            n_itens += len(lote.itens)
+            n_achados += len(lote.achados)
+            n_erros += len(lote.erros)
+        if exporter is not None and ckpt is not None:
+            n_notas = n_itens = n_achados = 0
+            for frames in ckpt.iter_lotes():
+                exporter.write(notas=frames["notas"], itens=frames["itens"], achados=frames["achados"])
+                n_notas += len(frames["notas"])
+                n_itens += len(frames["itens"])
+                n_achados += len(frames["achados"])
+            n_erros = len(ckpt.quarentena)
+    finally:
+        if exporter is not None:
+            exporter.close()
+
+    print(f"{n_notas} nota(s), {n_itens} item(ns), {n_achados} achado(s), {n_erros} em quarentena.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
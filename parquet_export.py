@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+import io
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import pandas as pd
+
+try:  # optional dependency: Parquet export is disabled without pyarrow
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except Exception:  # pragma: no cover
+    pa = None
+    pq = None
+
+# Hive-style partition columns (directory names), in order
+PARTITION_COLS = ["ano_mes", "emit_CNPJ"]
+UNKNOWN = "desconhecido"
+
+_STR = "str"
+_DICT = "dict"
+_F64 = "f64"
+_I32 = "i32"
+_TS = "ts"
+
+# Column layout per dataset. Code columns are dictionary-encoded.
+LAYOUT: Dict[str, Dict[str, str]] = {
+    "notas": {
+        "chave": _STR, "nNF": _STR, "serie": _DICT, "dhEmi": _TS,
+        "emit_xNome": _STR, "dest_xNome": _STR, "dest_CNPJ": _DICT,
+        "vNF": _F64, "arquivo": _STR,
+    },
+    "itens": {
+        "chave": _STR, "nNF": _STR, "serie": _DICT, "dhEmi": _TS,
+        "emit_xNome": _DICT, "dest_xNome": _DICT, "dest_CNPJ": _DICT, "vNF": _F64, "arquivo": _STR,
+        "nItem": _I32, "cProd": _STR, "xProd": _STR,
+        "NCM": _DICT, "CFOP": _DICT, "uCom": _DICT,
+        "qCom": _F64, "vUnCom": _F64, "vProd": _F64,
+        "CST_ICMS": _DICT, "CSOSN": _DICT, "orig": _DICT, "pICMS": _F64, "vICMS": _F64,
+    },
+    "achados": {
+        "chave": _STR, "nNF": _STR, "serie": _DICT, "nItem": _STR, "cProd": _STR, "xProd": _STR,
+        "severidade": _DICT, "campo": _DICT, "regra": _DICT, "base": _DICT,
+        "mensagem": _STR, "arquivo": _STR,
+    },
+}
+
+_ANO_MES_RE = re.compile(r"^\d{4}-\d{2}$")
+
+
+def pyarrow_disponivel() -> bool:
+    return pa is not None
+
+
+def _arrow_type(kind: str):
+    return {
+        _STR: pa.string(),
+        _DICT: pa.dictionary(pa.int32(), pa.string()),
+        _F64: pa.float64(),
+        _I32: pa.int32(),
+        _TS: pa.timestamp("us", tz="UTC"),
+    }[kind]
+
+
+def schema(dataset: str):
+    return pa.schema([pa.field(c, _arrow_type(k)) for c, k in LAYOUT[dataset].items()])
+
+
+def _to_table(df: pd.DataFrame, dataset: str):
+    """Build an Arrow table with the dataset's dtypes (missing columns become nulls)."""
+    arrays = []
+    n = len(df)
+    for col, kind in LAYOUT[dataset].items():
+        if col not in df.columns:
+            arrays.append(pa.nulls(n, type=_arrow_type(kind)))
+            continue
+        s = df[col]
+        if kind in (_STR, _DICT):
+            arr = pa.array(s.astype("string"), type=pa.string(), from_pandas=True)
+            if kind == _DICT:
+                arr = arr.dictionary_encode().cast(_arrow_type(_DICT))
+        elif kind == _F64:
+            arr = pa.array(pd.to_numeric(s, errors="coerce"), type=pa.float64(), from_pandas=True)
+        elif kind == _I32:
+            arr = pa.array(pd.to_numeric(s, errors="coerce").astype("Int32"), type=pa.int32(), from_pandas=True)
+        else:
+            arr = pa.array(pd.to_datetime(s, errors="coerce", utc=True, format="ISO8601"),
+                           type=_arrow_type(_TS), from_pandas=True)
+        arrays.append(arr)
+    return pa.Table.from_arrays(arrays, schema=schema(dataset))
+
+
+def _ano_mes(dh: pd.Series) -> pd.Series:
+    """Emission month (YYYY-MM) taken from the local date in dhEmi/dEmi."""
+    am = dh.fillna("").astype(str).str.strip().str.slice(0, 7)
+    return am.where(am.str.match(_ANO_MES_RE), UNKNOWN)
+
+
+def _safe(v: str) -> str:
+    v = re.sub(r"[^0-9A-Za-z_.-]", "", str(v or ""))
+    return v or UNKNOWN
+
+
+def ler_dataset(out_dir, dataset: str) -> pd.DataFrame:
+    """Read one dataset back; partition values stay strings (CNPJ keeps leading zeros)."""
+    import pyarrow.dataset as ds
+
+    part = ds.partitioning(pa.schema([(c, pa.string()) for c in PARTITION_COLS]), flavor="hive")
+    return ds.dataset(str(Path(out_dir) / dataset), format="parquet", partitioning=part).to_table().to_pandas()
+
+
+class ParquetExporter:
+    """
+    Streaming, partitioned Parquet writer for notas / itens / achados.
+
+    Layout: <out_dir>/<dataset>/ano_mes=YYYY-MM/emit_CNPJ=<cnpj>/part-NNNNN.parquet
+    Every `write()` appends one row group per touched partition, so the
+    caller can feed batches as the ingest produces them. At most
+    `max_open` files stay open; older partitions are closed and continue
+    in a new part file when written again.
+
+    Part numbers restart on every run, so a dataset folder that already has
+    files is refused (FileExistsError) unless `sobrescrever=True`, which
+    clears it first; stale parts would otherwise be read as current rows.
+    """
+
+    def __init__(self, out_dir, max_open: int = 64, compression: str = "zstd", sobrescrever: bool = False):
+        if pa is None:
+            raise RuntimeError("pyarrow não instalado: exportação Parquet indisponível.")
+        self.out_dir = Path(out_dir)
+        existentes = [self.out_dir / d for d in LAYOUT if (self.out_dir / d).is_dir() and any((self.out_dir / d).iterdir())]
+        if existentes and not sobrescrever:
+            raise FileExistsError(
+                f"{self.out_dir} já contém dados ({', '.join(p.name for p in existentes)})"
+            )
+        for p in existentes:
+            shutil.rmtree(p)
+        self.max_open = max_open
+        self.compression = compression
+        self._writers: "OrderedDict[Tuple[str, str, str], pq.ParquetWriter]" = OrderedDict()
+        self._part = 0
+        # chave -> (ano_mes, emit_CNPJ), used to place findings next to their notes
+        self._chaves: Dict[str, Tuple[str, str]] = {}
+        self.rows: Dict[str, int] = {d: 0 for d in LAYOUT}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _writer(self, dataset: str, ano_mes: str, cnpj: str):
+        key = (dataset, ano_mes, cnpj)
+        w = self._writers.get(key)
+        if w is not None:
+            self._writers.move_to_end(key)
+            return w
+        while len(self._writers) >= self.max_open:
+            _, old = self._writers.popitem(last=False)
+            old.close()
+        d = self.out_dir / dataset / f"ano_mes={ano_mes}" / f"emit_CNPJ={cnpj}"
+        d.mkdir(parents=True, exist_ok=True)
+        self._part += 1
+        w = pq.ParquetWriter(str(d / f"part-{self._part:05d}.parquet"), schema(dataset), compression=self.compression)
+        self._writers[key] = w
+        return w
+
+    def _write_partitioned(self, dataset: str, df: pd.DataFrame, ano_mes: pd.Series, cnpj: pd.Series) -> None:
+        if df.empty:
+            return
+        parts = pd.DataFrame({"a": ano_mes.to_numpy(), "c": cnpj.map(_safe).to_numpy()})
+        for (a, c), idx in parts.groupby(["a", "c"], sort=False).indices.items():
+            self._writer(dataset, a, c).write_table(_to_table(df.iloc[idx], dataset))
+        self.rows[dataset] += len(df)
+
+    def write(self, notas: Optional[pd.DataFrame] = None, itens: Optional[pd.DataFrame] = None,
+              achados: Optional[pd.DataFrame] = None) -> None:
+        """Append one batch. Notes should arrive no later than their items/findings."""
+        if notas is not None and not notas.empty:
+            dh = notas["dhEmi"] if "dhEmi" in notas.columns else pd.Series("", index=notas.index)
+            am = _ano_mes(dh)
+            cnpj = notas.get("emit_CNPJ", pd.Series("", index=notas.index)).fillna("").astype(str)
+            self._chaves.update(zip(notas.get("chave", pd.Series("", index=notas.index)).astype(str), zip(am, cnpj)))
+            self._write_partitioned("notas", notas, am, cnpj)
+
+        if itens is not None and not itens.empty:
+            dh = itens["dhEmi"] if "dhEmi" in itens.columns else pd.Series("", index=itens.index)
+            cnpj = itens.get("emit_CNPJ", pd.Series("", index=itens.index)).fillna("").astype(str)
+            self._write_partitioned("itens", itens, _ano_mes(dh), cnpj)
+
+        if achados is not None and not achados.empty:
+            chave = achados.get("chave", pd.Series("", index=achados.index)).fillna("").astype(str)
+            loc = chave.map(lambda k: self._chaves.get(k, (UNKNOWN, UNKNOWN)))
+            self._write_partitioned("achados", achados, loc.str[0], loc.str[1])
+
+    def close(self) -> None:
+        while self._writers:
+            _, w = self._writers.popitem(last=False)
+            w.close()
+
+
+def exportar_zip(notas: pd.DataFrame, itens: pd.DataFrame, achados=None,
+                 achados_extra: Optional[pd.DataFrame] = None, batch_rows: int = 100_000) -> bytes:
+    """
+    Write the partitioned dataset to a temp dir and return it zipped (for download in the UI).
+    `achados` may be a dataframe or compact findings (rendered chunk by chunk);
+    `achados_extra` (e.g. XSD findings) goes to the same dataset.
+    """
+    tmp = tempfile.mkdtemp(prefix="nfe_parquet_")
+    try:
+        with ParquetExporter(tmp) as exp:
+            exp.write(notas=notas)
+            for start in range(0, len(itens), batch_rows):
+                exp.write(itens=itens.iloc[start:start + batch_rows])
+            if hasattr(achados, "iter_frames"):
+                for chunk in achados.iter_frames(batch_rows):
+                    exp.write(achados=chunk)
+            elif achados is not None:
+                for start in range(0, len(achados), batch_rows):
+                    exp.write(achados=achados.iloc[start:start + batch_rows])
+            if achados_extra is not None and not achados_extra.empty:
+                exp.write(achados=achados_extra)
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_STORED) as zf:
+            for root, _, files in os.walk(tmp):
+                for f in files:
+                    p = Path(root) / f
+                    zf.write(p, p.relative_to(tmp).as_posix())
+        return buf.getvalue()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from .base_legal import BaseLegalDiff, diff_tables
+from .validator import Achados, validar_itens, validar_itens_compacto
+
+# Columns that identify an item inside the findings dataframe
+ITEM_KEY = ["chave", "nItem"]
+# Columns that identify a finding (item + rule + rendered message)
+FINDING_KEY = ITEM_KEY + ["regra", "mensagem"]
+
+
+@dataclass
+class RevalidacaoResult:
+    # Same type as the findings passed in (dataframe or compact `Achados`)
+    findings: Union[pd.DataFrame, Achados]      # full findings after revalidation
+    novos: Union[pd.DataFrame, Achados]         # findings that did not exist before
+    resolvidos: Union[pd.DataFrame, Achados]    # findings that no longer apply
+    itens_afetados: int = 0
+    itens_total: int = 0
+    diffs: Dict[str, BaseLegalDiff] = field(default_factory=dict)
+
+
+def _digits(s: pd.Series) -> pd.Series:
+    return s.fillna("").astype(str).str.strip().str.replace(r"\D", "", regex=True)
+
+
+def indexar_codigos(df_itens: pd.DataFrame) -> Dict[str, Dict[str, pd.Index]]:
+    """
+    Build a code -> item labels index per lookup group (NCM/CFOP/CST/CSOSN),
+    normalized exactly like the base tables in `table_codes`.
+    """
+    index: Dict[str, Dict[str, pd.Index]] = {}
+    if df_itens.empty:
+        return index
+
+    def col(name: str) -> pd.Series:
+        if name in df_itens.columns:
+            return df_itens[name].fillna("").astype(str).str.strip()
+        return pd.Series("", index=df_itens.index)
+
+    ncm = _digits(col("NCM"))
+    ncm = ncm[ncm != ""].str.zfill(8)
+    index["NCM"] = ncm.groupby(ncm).groups
+
+    cfop = _digits(col("CFOP"))
+    cfop = cfop[cfop != ""].str.zfill(4)
+    index["CFOP"] = cfop.groupby(cfop).groups
+
+    # Same precedence as the validator: CSOSN wins over CST when both exist
+    csosn = col("CSOSN")
+    cst = col("CST_ICMS")
+    csosn_k = "CSOSN:" + csosn[csosn != ""]
+    cst_k = "CST:" + cst[(csosn == "") & (cst != "")]
+    index["CSOSN"] = csosn_k.groupby(csosn_k).groups
+    index["CST"] = cst_k.groupby(cst_k).groups
+    return index
+
+
+def itens_afetados(index: Dict[str, Dict[str, pd.Index]], diffs: Dict[str, BaseLegalDiff]) -> pd.Index:
+    """Item labels whose NCM/CFOP/CST/CSOSN falls in the changed set of any diff."""
+    labels: List[pd.Index] = []
+    for diff in diffs.values():
+        for group in diff.toggled:
+            labels.extend(index.get(group, {}).values())
+        for code in diff.codes:
+            group = code.split(":", 1)[0] if ":" in code else diff.key.upper()
+            found = index.get(group, {}).get(code)
+            if found is not None:
+                labels.append(found)
+    if not labels:
+        return pd.Index([])
+    return labels[0].append(labels[1:]).unique()
+
+
+def diff_tabelas(old_tables: Dict[str, pd.DataFrame], new_tables: Dict[str, pd.DataFrame]) -> Dict[str, BaseLegalDiff]:
+    """Diff every Base Legal table between two `load_tables()` snapshots. Only non-empty diffs are returned."""
+    out: Dict[str, BaseLegalDiff] = {}
+    for key in set(old_tables) | set(new_tables):
+        d = diff_tables(key, old_tables.get(key, pd.DataFrame()), new_tables.get(key, pd.DataFrame()))
+        if d:
+            out[key] = d
+    return out
+
+
+def _key_frame(df: pd.DataFrame, cols: List[str]) -> pd.DataFrame:
+    df = df.copy()
+    for c in cols:
+        if c not in df.columns:
+            df[c] = ""
+    return df
+
+
+def _anti_join(left: pd.DataFrame, right: pd.DataFrame, on: List[str]) -> pd.DataFrame:
+    if left.empty or right.empty:
+        return left
+    m = left.merge(right[on].drop_duplicates(), on=on, how="left", indicator=True)
+    return m.loc[m["_merge"] == "left_only", left.columns].reset_index(drop=True)
+
+
+def _revalidar_compacto(df_itens: pd.DataFrame, achados: Achados, tables: Dict[str, pd.DataFrame],
+                        diffs: Dict[str, BaseLegalDiff], afetados: pd.Index) -> RevalidacaoResult:
+    """Compact path: findings are (regra, item position) pairs over the same df_itens."""
+    pos = df_itens.index.get_indexer(afetados)
+    pos = pos[pos >= 0]
+    if len(pos) == 0:
+        nenhum = achados.subset(np.zeros(len(achados), dtype=bool))
+        return RevalidacaoResult(findings=achados, novos=nenhum, resolvidos=nenhum,
+                                 itens_afetados=0, itens_total=len(df_itens), diffs=diffs)
+    afetado = np.isin(achados.item, pos)
+
+    sub = validar_itens_compacto(df_itens.iloc[pos], tables)
+    new_regra = sub.regra
+    new_item = pos[sub.item].astype(np.int32)
+
+    old_sub = achados.subset(afetado)
+    new_sub = Achados(df_itens, new_regra, new_item)
+    old_keys, new_keys = old_sub.pares(), new_sub.pares()
+
+    findings = Achados(
+        df_itens,
+        np.concatenate([achados.regra[~afetado], new_regra]),
+        np.concatenate([achados.item[~afetado], new_item]),
+    )
+    return RevalidacaoResult(
+        findings=findings,
+        novos=new_sub.subset(~np.isin(new_keys, old_keys)),
+        resolvidos=old_sub.subset(~np.isin(old_keys, new_keys)),
+        itens_afetados=len(pos),
+        itens_total=len(df_itens),
+        diffs=diffs,
+    )
+
+
+def revalidar_incremental(
+    df_itens: pd.DataFrame,
+    df_findings: Union[pd.DataFrame, Achados],
+    tables: Dict[str, pd.DataFrame],
+    diffs: Dict[str, BaseLegalDiff],
+    index: Optional[Dict[str, Dict[str, pd.Index]]] = None,
+) -> RevalidacaoResult:
+    """
+    Revalidate only the items touched by a Base Legal change.
+
+    `df_findings` is the previous result of `validar_itens(df_itens, ...)`
+    (or of `validar_itens_compacto`); `tables` is the new Base Legal. Findings
+    of unaffected items are kept as-is. Pass `index` (from `indexar_codigos`)
+    to reuse it across several changes.
+    """
+    if index is None:
+        index = indexar_codigos(df_itens)
+    afetados = itens_afetados(index, diffs)
+    if isinstance(df_findings, Achados):
+        return _revalidar_compacto(df_itens, df_findings, tables, diffs, afetados)
+
+    old = _key_frame(df_findings, FINDING_KEY)
+    empty = old.iloc[0:0]
+    if len(afetados) == 0:
+        return RevalidacaoResult(findings=old, novos=empty, resolvidos=empty,
+                                 itens_afetados=0, itens_total=len(df_itens), diffs=diffs)
+
+    sub = df_itens.loc[afetados].copy()
+    new_sub = _key_frame(validar_itens(sub, tables), FINDING_KEY)
+
+    # Previous findings that belong to the affected items
+    sub_keys = _key_frame(sub, ITEM_KEY)[ITEM_KEY].astype(str).apply(lambda s: s.str.strip()).drop_duplicates()
+    m = old.merge(sub_keys, on=ITEM_KEY, how="left", indicator=True)
+    in_sub = (m["_merge"] == "both").to_numpy()
+    old_sub = old.loc[in_sub].reset_index(drop=True)
+    kept = old.loc[~in_sub]
+
+    novos = _anti_join(new_sub, old_sub, FINDING_KEY)
+    resolvidos = _anti_join(old_sub, new_sub, FINDING_KEY)
+    findings = pd.concat([kept, new_sub], ignore_index=True) if not new_sub.empty else kept.reset_index(drop=True)
+
+    return RevalidacaoResult(
+        findings=findings,
+        novos=novos,
+        resolvidos=resolvidos,
+        itens_afetados=len(afetados),
+        itens_total=len(df_itens),
+        diffs=diffs,
+    )
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .validator import Finding
+
+try:  # optional dependency: the XSD stage is disabled without lxml
+    from lxml import etree
+except Exception:  # pragma: no cover
+    etree = None
+
+# Shipped next to the modules (utils/schemas/nfe); NFE_SCHEMAS_DIR overrides it
+SCHEMAS_DIR = Path(os.environ.get("NFE_SCHEMAS_DIR", Path(__file__).resolve().parent / "schemas" / "nfe"))
+
+# Layout version -> folder in SCHEMAS_DIR. Drop the official package of an
+# older layout (e.g. PL_008 for 3.10) in its folder to enable it.
+VERSIONS = ("4.00", "3.10", "2.00")
+# Root element -> schema file prefix
+ROOTS = {"NFe": "nfe", "nfeProc": "procNFe"}
+
+MAX_ERRORS_PER_FILE = 50
+
+_ELEMENT_RE = re.compile(r"Element '(?:\{[^}]*\})?([^']+)'")
+_NS_RE = re.compile(r"\{[^}]*\}")
+
+# Compiled schemas are per thread: an XMLSchema object keeps its error_log
+# on the instance, so it cannot validate on two threads at once.
+_LOCAL = threading.local()
+_GERACAO = 0  # bumped by clear_cache() to invalidate every thread's cache
+
+# Long-lived workers, so each one's compiled schemas survive across uploads
+MAX_WORKERS = min(4, os.cpu_count() or 1)
+_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def lxml_disponivel() -> bool:
+    return etree is not None
+
+
+def schema_path(versao: str, raiz: str = "NFe") -> Path:
+    return SCHEMAS_DIR / f"v{versao}" / f"{ROOTS[raiz]}_v{versao}.xsd"
+
+
+def schema_disponivel(versao: str = "4.00", raiz: str = "NFe") -> bool:
+    return lxml_disponivel() and raiz in ROOTS and schema_path(versao, raiz).exists()
+
+
+def _get_schema(versao: str, raiz: str):
+    """
+    Compiled schema for (version, root), built once per thread and reused by
+    every file that thread validates. None when unavailable.
+    """
+    if getattr(_LOCAL, "geracao", None) != _GERACAO:
+        _LOCAL.schemas = {}
+        _LOCAL.geracao = _GERACAO
+    key = (versao, raiz)
+    if key not in _LOCAL.schemas:
+        if not schema_disponivel(versao, raiz):
+            return None
+        _LOCAL.schemas[key] = etree.XMLSchema(etree.parse(str(schema_path(versao, raiz))))
+    return _LOCAL.schemas[key]
+
+
+def executor() -> ThreadPoolExecutor:
+    """Process-wide pool for `validar_schema` (do not shut it down)."""
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="xsd")
+        return _EXECUTOR
+
+
+def clear_cache() -> None:
+    global _GERACAO
+    _GERACAO += 1
+
+
+def _local(tag: str) -> str:
+    return tag.split("}", 1)[-1] if "}" in tag else tag
+
+
+def _row(finding: Finding, chave: str = "", arquivo: str = "") -> Dict[str, str]:
+    row = {"chave": chave, "arquivo": arquivo}
+    row.update(asdict(finding))
+    return row
+
+
+def validar_schema(xml_bytes: bytes, arquivo: str = "") -> List[Dict[str, str]]:
+    """
+    Validate one NF-e (NFe or nfeProc) against the official XSD of its layout
+    version. Returns finding rows (same columns as `validar_itens` plus `arquivo`).
+    """
+    if etree is None:
+        return []
+
+    parser = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=True)
+    try:
+        root = etree.fromstring(xml_bytes, parser)
+    except etree.XMLSyntaxError as e:
+        return [_row(Finding("ERRO", "XML", f"XML mal formado: {e}", regra="XML_MAL_FORMADO"), arquivo=arquivo)]
+
+    raiz = _local(root.tag)
+    inf = root.find(".//{*}infNFe")
+    chave = (inf.get("Id", "") if inf is not None else "").replace("NFe", "")
+    versao = (inf.get("versao") if inf is not None else None) or root.get("versao") or ""
+
+    if raiz not in ROOTS:
+        return [_row(Finding("ALERTA", "XML", f"Elemento raiz '{raiz}' não é NFe/nfeProc; schema não aplicado.",
+                             regra="SCHEMA_RAIZ_DESCONHECIDA"), chave, arquivo)]
+
+    schema = _get_schema(versao, raiz)
+    if schema is None:
+        return [_row(Finding("ALERTA", "XML", f"Schema XSD da versão '{versao or '(ausente)'}' não disponível.",
+                             regra="SCHEMA_INDISPONIVEL"), chave, arquivo)]
+
+    ok = schema.validate(root)
+    errors = [] if ok else list(schema.error_log)
+
+    base = schema_path(versao, raiz).name
+    out: List[Dict[str, str]] = []
+    for e in errors[:MAX_ERRORS_PER_FILE]:
+        m = _ELEMENT_RE.search(e.message or "")
+        campo = m.group(1) if m else "XML"
+        msg = _NS_RE.sub("", e.message or "")
+        out.append(_row(Finding("ERRO", campo, f"linha {e.line}: {msg}", regra="SCHEMA_XSD", base=base),
+                        chave, arquivo))
+    if len(errors) > MAX_ERRORS_PER_FILE:
+        out.append(_row(Finding("ERRO", "XML", f"... mais {len(errors) - MAX_ERRORS_PER_FILE} violação(ões) de schema omitidas.",
+                                regra="SCHEMA_XSD", base=base), chave, arquivo))
+    return out
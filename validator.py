@@ -1,8 +1,10 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import Dict, List, Optional
+from string import Formatter
+from typing import Dict, Iterator, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 
 @dataclass
@@ -14,22 +16,196 @@ class Finding:
     base: str = ""
 
 
+@dataclass(frozen=True)
+class Regra:
+    codigo: str
+    severidade: str
+    campo: str
+    template: str  # rendered lazily; fields come from the item (see _campos)
+    base: str = ""
+
+
+# Order matters: it is the order in which findings of one item are listed
+REGRAS: List[Regra] = [
+    Regra("FORMATO_NCM", "ALERTA", "NCM", "NCM com tamanho incomum ({ncm_len} dígitos): {ncm}"),
+    Regra("NCM_AUSENTE_OU_ZERADO", "ALERTA", "NCM", "NCM ausente ou zerado: {ncm_ou_vazio}"),
+    Regra("FORMATO_CFOP", "ALERTA", "CFOP", "CFOP com tamanho incomum ({cfop_len} dígitos): {cfop}"),
+    Regra("CFOP_AUSENTE", "ALERTA", "CFOP", "CFOP ausente"),
+    Regra("CSOSN_NAO_ENCONTRADO", "ERRO", "CSOSN", "CSOSN '{csosn}' não encontrado na base.", "cst_csosn_regras.xlsx"),
+    Regra("CST_NAO_ENCONTRADO", "ERRO", "CST", "CST '{cst}' não encontrado na base.", "cst_csosn_regras.xlsx"),
+    Regra("CST_CSOSN_AUSENTE", "ALERTA", "CST/CSOSN", "CST/CSOSN ausente no item"),
+    Regra("NCM_NAO_ENCONTRADO", "ERRO", "NCM", "NCM '{ncm_norm}' não encontrado na base.", "ncm_regras.xlsx"),
+    Regra("CFOP_NAO_ENCONTRADO", "ERRO", "CFOP", "CFOP '{cfop_norm}' não encontrado na base.", "cfop_regras.xlsx"),
+]
+REGRA_ID = {r.codigo: i for i, r in enumerate(REGRAS)}
+_ERRO = np.array([r.severidade == "ERRO" for r in REGRAS])
+
+# Item columns copied into every rendered finding row
+META_COLS = ["chave", "nNF", "serie", "dEmi", "nItem", "cProd", "xProd"]
+FINDING_COLS = META_COLS + ["severidade", "campo", "mensagem", "regra", "base"]
+
+# Rollup dimensions for the summary views: name -> item column(s)
+ROLLUPS = {"NCM": ["NCM"], "CFOP": ["CFOP"], "emitente": ["emit_CNPJ", "emit_xNome"]}
+ROLLUP_DIMS = ["regra", "campo"] + list(ROLLUPS)
+
+
 def _norm_code(x: str) -> str:
     return str(x or "").strip()
 
 
-def validar_itens(df_itens: pd.DataFrame, tables: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+def _col(df: pd.DataFrame, name: str) -> pd.Series:
+    if name not in df.columns:
+        return pd.Series("", index=df.index, dtype=object)
+    return df[name].fillna("").astype(str).str.strip()
+
+
+def _digits(s: pd.Series) -> pd.Series:
+    return s.str.replace(r"\D", "", regex=True)
+
+
+def _campos(df: pd.DataFrame) -> Dict[str, pd.Series]:
+    """Template fields for a slice of items."""
+    ncm = _col(df, "NCM")
+    cfop = _col(df, "CFOP")
+    ncm_d = _digits(ncm)
+    cfop_d = _digits(cfop)
+    return {
+        "ncm": ncm,
+        "ncm_len": ncm_d.str.len().astype(str),
+        "ncm_ou_vazio": ncm.where(ncm != "", "(vazio)"),
+        "ncm_norm": ncm_d.str.zfill(8),
+        "cfop": cfop,
+        "cfop_len": cfop_d.str.len().astype(str),
+        "cfop_norm": cfop_d.str.zfill(4),
+        "cst": _col(df, "CST_ICMS"),
+        "csosn": _col(df, "CSOSN"),
+    }
+
+
+def _render(template: str, campos: Dict[str, pd.Series], index: pd.Index) -> pd.Series:
+    out = pd.Series("", index=index, dtype=object)
+    for literal, field, _, _ in Formatter().parse(template):
+        if literal:
+            out = out + literal
+        if field:
+            out = out + campos[field]
+    return out
+
+
+class Achados:
     """
-    Valida itens do XML contra a base legal (tabelas) e também checks de formato.
-    Retorna um dataframe de achados (0..n linhas).
+    Compact findings: one (regra, item) pair per finding, as int8/int32 arrays
+    referencing the rows of `itens` (which is not copied). Messages and meta
+    columns are only rendered by `to_frame`/`iter_frames`; counts are computed
+    at construction, rollups on first access (see `rollup`).
     """
-    findings: List[Dict[str, str]] = []
 
-    ncm_tbl = tables.get("ncm", pd.DataFrame()).copy()
-    cfop_tbl = tables.get("cfop", pd.DataFrame()).copy()
-    cst_tbl = tables.get("cst", pd.DataFrame()).copy()
+    def __init__(self, itens: pd.DataFrame, regra: np.ndarray, item: np.ndarray):
+        order = np.lexsort((regra, item))
+        self.itens = itens
+        self.regra = np.asarray(regra, dtype=np.int8)[order]
+        self.item = np.asarray(item, dtype=np.int32)[order]
+        self.erros = int(_ERRO[self.regra].sum()) if len(self.regra) else 0
+        self.alertas = len(self.regra) - self.erros
+        self._rollups: Dict[str, pd.DataFrame] = {}
+
+    @classmethod
+    def vazio(cls, itens: pd.DataFrame) -> "Achados":
+        return cls(itens, np.zeros(0, dtype=np.int8), np.zeros(0, dtype=np.int32))
+
+    def __len__(self) -> int:
+        return len(self.regra)
+
+    @property
+    def empty(self) -> bool:
+        return len(self.regra) == 0
+
+    def memory_usage(self, deep: bool = True) -> int:
+        """Own footprint only: `itens` is referenced, not owned."""
+        return int(self.regra.nbytes + self.item.nbytes + sum(r.memory_usage(deep=True).sum() for r in self._rollups.values()))
+
+    def pares(self) -> np.ndarray:
+        """One int64 per finding (item, regra); used for set operations between results."""
+        return self.item.astype(np.int64) * len(REGRAS) + self.regra
+
+    def subset(self, mask: np.ndarray) -> "Achados":
+        return Achados(self.itens, self.regra[mask], self.item[mask])
+
+    @property
+    def rollups(self) -> Dict[str, pd.DataFrame]:
+        return {nome: self.rollup(nome) for nome in ROLLUP_DIMS}
+
+    def rollup(self, nome: str) -> pd.DataFrame:
+        """Finding counts (erros/alertas/total) per `nome` in ROLLUP_DIMS; computed once, on first use."""
+        if nome not in self._rollups:
+            self._rollups[nome] = self._rollup(nome)
+        return self._rollups[nome]
+
+    def _rollup(self, nome: str) -> pd.DataFrame:
+        n_reg = len(REGRAS)
+        por_regra = np.bincount(self.regra, minlength=n_reg) if len(self.regra) else np.zeros(n_reg, dtype=int)
+        if nome in ("regra", "campo"):
+            regra_df = pd.DataFrame({
+                "regra": [r.codigo for r in REGRAS],
+                "severidade": [r.severidade for r in REGRAS],
+                "campo": [r.campo for r in REGRAS],
+                "total": por_regra,
+            })
+            regra_df = regra_df[regra_df["total"] > 0].sort_values("total", ascending=False).reset_index(drop=True)
+            if nome == "regra":
+                return regra_df
+            campo_df = pd.DataFrame({
+                "campo": regra_df["campo"],
+                "erros": np.where(regra_df["severidade"] == "ERRO", regra_df["total"], 0),
+                "alertas": np.where(regra_df["severidade"] == "ERRO", 0, regra_df["total"]),
+            }).groupby("campo", as_index=False).sum()
+            campo_df["total"] = campo_df["erros"] + campo_df["alertas"]
+            return campo_df.sort_values("total", ascending=False).reset_index(drop=True)
+
+        # Item-level dimensions: keys are built for the flagged items only
+        cols = ROLLUPS[nome]
+        itens_u, inv = np.unique(self.item, return_inverse=True)
+        sel = self.itens.iloc[itens_u]
+        key = _col(sel, cols[0]) if len(cols) == 1 else _col(sel, cols[0]) + " — " + _col(sel, cols[1])
+        codes, uniques = pd.factorize(key.to_numpy())
+        k = codes[inv] if len(inv) else np.zeros(0, dtype=np.int64)
+        erro = _ERRO[self.regra] if len(self.regra) else np.zeros(0, dtype=bool)
+        erros = np.bincount(k, weights=erro, minlength=len(uniques)).astype(int)
+        total = np.bincount(k, minlength=len(uniques))
+        df = pd.DataFrame({nome: uniques, "erros": erros, "alertas": total - erros, "total": total})
+        return df.sort_values("total", ascending=False).reset_index(drop=True)
+
+    def to_frame(self, start: int = 0, stop: Optional[int] = None) -> pd.DataFrame:
+        """Render findings [start:stop) as the classic one-row-per-finding dataframe."""
+        regra = self.regra[start:stop]
+        item = self.item[start:stop]
+        if len(regra) == 0:
+            return pd.DataFrame(columns=FINDING_COLS)
+        sel = self.itens.iloc[item]
+        out = pd.DataFrame({c: _col(sel, c).to_numpy() for c in META_COLS})
+        mensagem = np.empty(len(regra), dtype=object)
+        for rid in np.unique(regra):
+            mask = regra == rid
+            r = REGRAS[rid]
+            sub = sel.iloc[np.flatnonzero(mask)]
+            mensagem[mask] = _render(r.template, _campos(sub), sub.index).to_numpy()
+        out["severidade"] = np.array([r.severidade for r in REGRAS], dtype=object)[regra]
+        out["campo"] = np.array([r.campo for r in REGRAS], dtype=object)[regra]
+        out["mensagem"] = mensagem
+        out["regra"] = np.array([r.codigo for r in REGRAS], dtype=object)[regra]
+        out["base"] = np.array([r.base for r in REGRAS], dtype=object)[regra]
+        return out
+
+    def iter_frames(self, chunk: int = 100_000) -> Iterator[pd.DataFrame]:
+        for start in range(0, len(self), chunk):
+            yield self.to_frame(start, start + chunk)
+
+
+def _lookup_sets(tables: Dict[str, pd.DataFrame]) -> Tuple[set, set, set, set]:
+    ncm_tbl = tables.get("ncm", pd.DataFrame())
+    cfop_tbl = tables.get("cfop", pd.DataFrame())
+    cst_tbl = tables.get("cst", pd.DataFrame())
 
-    # Build lookup sets
     ncm_set = set()
     if not ncm_tbl.empty and "ncm" in ncm_tbl.columns:
         ncm_set = set(ncm_tbl["ncm"].astype(str).str.replace(r"\D", "", regex=True).str.zfill(8))
@@ -41,76 +217,53 @@ def validar_itens(df_itens: pd.DataFrame, tables: Dict[str, pd.DataFrame]) -> pd
     cst_set = set()
     csosn_set = set()
     if not cst_tbl.empty and {"codigo","tipo"}.issubset(set(cst_tbl.columns)):
-        tmp = cst_tbl.copy()
-        tmp["tipo"] = tmp["tipo"].astype(str).str.upper().str.strip()
-        tmp["codigo"] = tmp["codigo"].astype(str).str.strip()
-        cst_set = set(tmp.loc[tmp["tipo"]=="CST","codigo"])
-        csosn_set = set(tmp.loc[tmp["tipo"]=="CSOSN","codigo"])
-
-    # Ensure expected cols exist
-    for col in ["NCM","CFOP","CST_ICMS","CSOSN","xProd","cProd","nItem","chave","nNF","serie","dEmi"]:
-        if col not in df_itens.columns:
-            df_itens[col] = ""
-
-    for idx, r in df_itens.iterrows():
-        ncm = _norm_code(r.get("NCM",""))
-        cfop = _norm_code(r.get("CFOP",""))
-        cst = _norm_code(r.get("CST_ICMS",""))
-        csosn = _norm_code(r.get("CSOSN",""))
-
-        meta = {
-            "chave": _norm_code(r.get("chave","")),
-            "nNF": _norm_code(r.get("nNF","")),
-            "serie": _norm_code(r.get("serie","")),
-            "dEmi": _norm_code(r.get("dEmi","")),
-            "nItem": _norm_code(r.get("nItem","")),
-            "cProd": _norm_code(r.get("cProd","")),
-            "xProd": _norm_code(r.get("xProd","")),
-        }
-
-        def add(severidade, campo, mensagem, regra="", base=""):
-            row = dict(meta)
-            row.update({
-                "severidade": severidade,
-                "campo": campo,
-                "mensagem": mensagem,
-                "regra": regra,
-                "base": base,
-            })
-            findings.append(row)
-
-        # Basic format validations
-        ncm_digits = "".join([c for c in ncm if c.isdigit()])
-        if ncm_digits and len(ncm_digits) != 8:
-            add("ALERTA", "NCM", f"NCM com tamanho incomum ({len(ncm_digits)} dígitos): {ncm}", regra="FORMATO_NCM")
-        if ncm_digits == "" or ncm_digits == "00000000":
-            add("ALERTA", "NCM", f"NCM ausente ou zerado: {ncm or '(vazio)'}", regra="NCM_AUSENTE_OU_ZERADO")
-
-        cfop_digits = "".join([c for c in cfop if c.isdigit()])
-        if cfop_digits and len(cfop_digits) != 4:
-            add("ALERTA", "CFOP", f"CFOP com tamanho incomum ({len(cfop_digits)} dígitos): {cfop}", regra="FORMATO_CFOP")
-        if cfop_digits == "":
-            add("ALERTA", "CFOP", "CFOP ausente", regra="CFOP_AUSENTE")
-
-        # CST/CSOSN presence
-        if csosn:
-            if csosn_set and csosn not in csosn_set:
-                add("ERRO", "CSOSN", f"CSOSN '{csosn}' não encontrado na base.", regra="CSOSN_NAO_ENCONTRADO", base="cst_csosn_regras.xlsx")
-        elif cst:
-            if cst_set and cst not in cst_set:
-                add("ERRO", "CST", f"CST '{cst}' não encontrado na base.", regra="CST_NAO_ENCONTRADO", base="cst_csosn_regras.xlsx")
-        else:
-            add("ALERTA", "CST/CSOSN", "CST/CSOSN ausente no item", regra="CST_CSOSN_AUSENTE")
-
-        # Cross checks with base tables (existence)
-        if ncm_set and ncm_digits:
-            ncm_norm = ncm_digits.zfill(8)
-            if ncm_norm not in ncm_set:
-                add("ERRO", "NCM", f"NCM '{ncm_norm}' não encontrado na base.", regra="NCM_NAO_ENCONTRADO", base="ncm_regras.xlsx")
-
-        if cfop_set and cfop_digits:
-            cfop_norm = cfop_digits.zfill(4)
-            if cfop_norm not in cfop_set:
-                add("ERRO", "CFOP", f"CFOP '{cfop_norm}' não encontrado na base.", regra="CFOP_NAO_ENCONTRADO", base="cfop_regras.xlsx")
-
-    return pd.DataFrame(findings)
+        tipo = cst_tbl["tipo"].astype(str).str.upper().str.strip()
+        codigo = cst_tbl["codigo"].astype(str).str.strip()
+        cst_set = set(codigo[tipo == "CST"])
+        csosn_set = set(codigo[tipo == "CSOSN"])
+    return ncm_set, cfop_set, cst_set, csosn_set
+
+
+def validar_itens_compacto(df_itens: pd.DataFrame, tables: Dict[str, pd.DataFrame]) -> Achados:
+    """
+    Valida itens do XML contra a base legal (tabelas) e também checks de formato,
+    de forma vetorizada. Retorna achados compactos (ver `Achados`).
+    """
+    ncm_set, cfop_set, cst_set, csosn_set = _lookup_sets(tables)
+
+    ncm_d = _digits(_col(df_itens, "NCM"))
+    cfop_d = _digits(_col(df_itens, "CFOP"))
+    cst = _col(df_itens, "CST_ICMS")
+    csosn = _col(df_itens, "CSOSN")
+    ncm_len = ncm_d.str.len()
+    cfop_len = cfop_d.str.len()
+
+    false = pd.Series(False, index=df_itens.index)
+    tem_csosn = csosn != ""
+    tem_cst = ~tem_csosn & (cst != "")
+    masks = {
+        "FORMATO_NCM": (ncm_len > 0) & (ncm_len != 8),
+        "NCM_AUSENTE_OU_ZERADO": (ncm_d == "") | (ncm_d == "00000000"),
+        "FORMATO_CFOP": (cfop_len > 0) & (cfop_len != 4),
+        "CFOP_AUSENTE": cfop_d == "",
+        "CSOSN_NAO_ENCONTRADO": tem_csosn & ~csosn.isin(csosn_set) if csosn_set else false,
+        "CST_NAO_ENCONTRADO": tem_cst & ~cst.isin(cst_set) if cst_set else false,
+        "CST_CSOSN_AUSENTE": ~tem_csosn & (cst == ""),
+        "NCM_NAO_ENCONTRADO": (ncm_len > 0) & ~ncm_d.str.zfill(8).isin(ncm_set) if ncm_set else false,
+        "CFOP_NAO_ENCONTRADO": (cfop_len > 0) & ~cfop_d.str.zfill(4).isin(cfop_set) if cfop_set else false,
+    }
+
+    regras, itens = [], []
+    for codigo, mask in masks.items():
+        pos = np.flatnonzero(mask.to_numpy())
+        itens.append(pos)
+        regras.append(np.full(len(pos), REGRA_ID[codigo], dtype=np.int8))
+    return Achados(df_itens, np.concatenate(regras), np.concatenate(itens))
+
+
+def validar_itens(df_itens: pd.DataFrame, tables: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """
+    Valida itens do XML contra a base legal (tabelas) e também checks de formato.
+    Retorna um dataframe de achados (0..n linhas).
+    """
+    return validar_itens_compacto(df_itens, tables).to_frame()